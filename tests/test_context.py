@@ -0,0 +1,50 @@
+import copy
+import os
+import unittest
+
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Paragraph
+
+from xhtml2pdf.context import PisaContext, get_paragraph_fragment, _FRAG_DEFAULTS
+
+_image = os.path.join(os.path.dirname(__file__), os.pardir, "test", "img", "denker.png")
+
+
+class FragmentDefaultsTestCase(unittest.TestCase):
+
+    def test_reportlab_image_keeps_its_size(self):
+        """Asserts plain ReportLab fragments do not see the xhtml2pdf defaults"""
+        paragraph = Paragraph('<img src="%s"/>' % _image, getSampleStyleSheet()["Normal"])
+        sizes = [(frag.cbDefn.width, frag.cbDefn.height)
+                 for frag in paragraph.frags if getattr(frag, "cbDefn", None) is not None]
+        self.assertEqual(sizes, [ImageReader(_image).getSize()])
+
+    def test_copies_keep_the_defaults(self):
+        """Asserts cloned and copied fragments still fall back to _FRAG_DEFAULTS"""
+        frag = get_paragraph_fragment(getSampleStyleSheet()["Normal"])
+        for other in (frag.clone(), frag.clone(text="x"), copy.copy(frag)):
+            self.assertEqual(other.borderWidth, _FRAG_DEFAULTS["borderWidth"])
+            self.assertEqual(other.leadingSource, _FRAG_DEFAULTS["leadingSource"])
+            self.assertIsNone(other.width)
+            self.assertFalse(hasattr(other, "noSuchAttribute"))
+
+
+class RegisterFontTestCase(unittest.TestCase):
+
+    def test_name_and_aliases_map_to_one_name(self):
+        """Asserts the font and its aliases map to the same name"""
+        c = PisaContext(".")
+        c.register_font(u"F\xfcnf", [u" F\xfcnf-Alias ", "other"])
+        self.assertEqual(c.fontList[u"f\xfcnf"], u"F\xfcnf")
+        self.assertEqual(c.fontList[u"f\xfcnf-alias"], u"F\xfcnf")
+        self.assertEqual(c.fontList["other"], u"F\xfcnf")
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
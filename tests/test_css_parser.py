@@ -0,0 +1,167 @@
+import unittest
+
+from xhtml2pdf.w3c import css
+from xhtml2pdf.w3c.cssParser import CSSParseError
+
+
+def _parser():
+    return css.CSSParser(css.CSSBuilder(mediumSet=["all", "print"]))
+
+
+def _rules(src):
+    """The normal and the important rules by selector string"""
+    normal, important = _parser().parse(src)
+    return (dict((str(k), v) for k, v in normal.items()),
+            dict((str(k), v) for k, v in important.items()))
+
+
+def _selectors(src):
+    normal, important = _parser().parse(src)
+    return list(normal)
+
+
+def _function(term):
+    """Nested (name, params) tuples for a function term"""
+    if isinstance(term, css.CSSTerminalFunction):
+        return term.name, [_function(param) for param in term.params]
+    return term
+
+
+class StringTestCase(unittest.TestCase):
+
+    def test_escaped_quotes(self):
+        """Asserts an escaped quote does not end the string"""
+        normal, important = _rules(r'p { content: "a\"b" } q { content: ' + r"'it\'s' }")
+        self.assertEqual(normal["p"]["content"], r'a\"b')
+        self.assertEqual(normal["q"]["content"], r"it\'s")
+
+    def test_escaped_newline(self):
+        normal, important = _rules('p { content: "a\\\nb" }')
+        self.assertEqual(normal["p"]["content"], "a\\\nb")
+
+    def test_unterminated_string(self):
+        """Asserts a long unterminated string with escapes fails right away"""
+        self.assertRaises(CSSParseError, _parser().parse, 'p { content: "' + "a\\" * 5000 + " }")
+
+
+class ImportantTestCase(unittest.TestCase):
+
+    def test_important(self):
+        normal, important = _rules("p { color: red !important; margin-top: 1px }")
+        self.assertEqual(normal, {"p": {"margin-top": ("1", "px")}})
+        self.assertEqual(important, {"p": {"color": "red"}})
+
+    def test_bang_ends_the_expression(self):
+        """Asserts "!" ends the value with or without spaces around it"""
+        for src in ("p { color: red!important }", "p { color: red ! important }"):
+            self.assertEqual(_rules(src), ({}, {"p": {"color": "red"}}))
+        normal, important = _rules("p { margin: 1px 2px!important }")
+        self.assertEqual(important["p"]["margin-left"], ("2", "px"))
+        self.assertEqual(important["p"]["margin-top"], ("1", "px"))
+
+    def test_inline_important(self):
+        self.assertEqual(_parser().parse_inline("color: red !important; margin-top: 1px"),
+                         ({"margin-top": ("1", "px")}, {"color": "red"}))
+
+
+class FunctionTestCase(unittest.TestCase):
+
+    def test_nested_functions(self):
+        normal, important = _rules("p { foo: f(g(1px, h(2)), 3) }")
+        self.assertEqual(_function(normal["p"]["foo"]),
+                         ("f", [("g", [("1", "px"), ("h", ["2"])]), "3"]))
+
+    def test_deeply_nested_functions(self):
+        """Asserts nesting is not limited by the recursion limit"""
+        depth = 2000
+        normal, important = _rules("p { foo: " + "f(" * depth + "1" + ")" * depth + " }")
+        term = normal["p"]["foo"]
+        for _ in range(depth):
+            self.assertEqual(term.name, "f")
+            term, = term.params
+        self.assertEqual(term, "1")
+
+
+class AtRuleTestCase(unittest.TestCase):
+
+    def test_keywords_ignore_case(self):
+        self.assertEqual(_rules("@MEDIA print { p { color: red } }"), ({"p": {"color": "red"}}, {}))
+        self.assertEqual(_rules("@Page { margin-top: 1cm }"), ({"*": {"margin-top": ("1", "cm")}}, {}))
+        self.assertEqual(_rules("@FONT-FACE { font-family: x; src: url(a.ttf) }"),
+                         ({"*": {"font-family": "x", "src": "a.ttf"}}, {}))
+
+    def test_keyword_prefixes_are_unknown_rules(self):
+        """Asserts @pages and @mediaprint are skipped as unknown at-rules"""
+        for src in ("@pages { margin-top: 1cm } q { color: blue }",
+                    "@pages; q { color: blue }",
+                    "@mediaprint { p { color: red } } q { color: blue }",
+                    "@mediaprint; q { color: blue }"):
+            self.assertEqual(_rules(src), ({"q": {"color": "blue"}}, {}))
+
+    def test_unknown_rule_with_rulesets(self):
+        src = "@foo { p { color: red } @media print { s { color: red } } } q { color: blue }"
+        self.assertEqual(_rules(src), ({"q": {"color": "blue"}}, {}))
+
+
+class SelectorTestCase(unittest.TestCase):
+
+    def test_namespaces(self):
+        names = [s.completeName for s in _selectors("ns|q, *|r, s { color: red }")]
+        self.assertEqual(sorted(names, key=lambda name: name[2]),
+                         [("ns", None, "q"), ("*", "*", "r"), (None, None, "s")])
+
+    def test_hash_and_class_runs(self):
+        """Asserts a run of #id.class qualifiers keeps its order"""
+        selector, = _selectors("p#a.b.c#d { color: red }")
+        self.assertEqual([getattr(q, "hashId", None) or q.classId for q in selector.qualifiers],
+                         ["a", "b", "c", "d"])
+        self.assertEqual([q.isHash() for q in selector.qualifiers], [True, False, False, True])
+        self.assertEqual(selector.specificity(), (False, 2, 2, 1))
+
+    def test_attribute_operators(self):
+        parser = _parser()
+        for op in parser.attribute_operators:
+            selector, = _selectors('a[x%s"y"] { color: red }' % op)
+            qualifier, = selector.qualifiers
+            self.assertEqual((qualifier.name, qualifier.op, qualifier.value), ("x", op, "y"))
+        selector, = _selectors("a[href] { color: red }")
+        qualifier, = selector.qualifiers
+        self.assertEqual((qualifier.name, qualifier.op), ("href", None))
+        self.assertIs(qualifier.value, NotImplemented)
+
+
+class ParseErrorTestCase(unittest.TestCase):
+
+    def parse_error(self, src):
+        try:
+            _parser().parse(src)
+        except CSSParseError as err:
+            return err
+        self.fail("%r parsed without an error" % src)
+
+    def test_error_in_the_middle(self):
+        src = "q {} a[x$=y] { color: red }"
+        err = self.parse_error(src)
+        self.assertEqual(err.ctxsrc, src[6:])
+        self.assertEqual(err.srcCtxIdx, 2)
+        self.assertEqual(err.srcFullIdx, 8)
+        self.assertEqual(err.ctxsrcFullIdx, 6)
+        self.assertTrue(str(err).endswith("('[x', '$=y] { color: red }')"))
+
+    def test_error_at_the_end(self):
+        """Asserts an error at the end of the source points at the end"""
+        src = "p { color: red; } q { color: red /* comment */"
+        err = self.parse_error(src)
+        self.assertEqual(err.ctxsrc, "{ color: red ")
+        self.assertEqual(err.srcCtxIdx, len(err.ctxsrc))
+        self.assertEqual(err.srcFullIdx, len(src))
+        self.assertTrue(str(err).endswith("('{ color: red ', '')"))
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
@@ -0,0 +1,183 @@
+import io
+import os
+import tempfile
+import unittest
+
+from reportlab.lib.pagesizes import A5
+from reportlab.pdfgen.canvas import Canvas
+
+from xhtml2pdf import document
+from xhtml2pdf.context import PisaContext
+from xhtml2pdf.document import pisa_document, pisa_add_backgrounds, _copy_to_dest
+from xhtml2pdf.pdf import pisaPDF
+from xhtml2pdf.util import PyPDF2, fitz
+
+_html = "<p>Hello World</p>"
+_background = os.path.join(os.path.dirname(__file__), os.pardir, "test", "pdf", "background-sample.pdf")
+
+
+class DocumentDestTestCase(unittest.TestCase):
+
+    def assertPDF(self, data):
+        self.assertEqual(data[:5], b"%PDF-")
+
+    def assertAddable(self, context):
+        pdf = pisaPDF()
+        pdf.addDocument(context)
+        self.assertEqual(pdf.files, [context.dest])
+
+    def test_no_dest(self):
+        """Asserts the PDF can be read back from context.dest"""
+        context = pisa_document(_html)
+        self.assertPDF(context.dest.read())
+        self.assertAddable(context)
+
+    def test_bytesio_dest(self):
+        """Asserts the PDF is written to the given BytesIO"""
+        dest = io.BytesIO()
+        context = pisa_document(_html, dest)
+        self.assertIs(context.dest, dest)
+        self.assertPDF(dest.getvalue())
+        self.assertAddable(context)
+
+    def test_file_dest_with_content(self):
+        """Asserts the PDF is written after what a file already holds"""
+        with tempfile.TemporaryFile() as dest:
+            dest.write(b"existing")
+            context = pisa_document(_html, dest)
+            self.assertIs(context.dest, dest)
+            dest.seek(0)
+            data = dest.read()
+            self.assertEqual(data[:8], b"existing")
+            self.assertPDF(data[8:])
+            self.assertAddable(context)
+
+
+@unittest.skipUnless(hasattr(os, "sendfile"), "os.sendfile is not available")
+class CopyToDestTestCase(unittest.TestCase):
+    """
+    A document bigger than capacity has spilled to disk, _copy_to_dest then
+    hands it to os.sendfile when dest is a real file
+    """
+
+    capacity = 1024
+    data = b"%PDF-" + b"x" * 20000
+
+    def setUp(self):
+        self.sendfile = os.sendfile
+        self.sendfile_calls = 0
+
+        # Send at most 4096 bytes per call to go through the partial send loop
+        def sendfile(out_fd, in_fd, offset, count):
+            self.sendfile_calls += 1
+            return self.sendfile(out_fd, in_fd, offset, min(count, 4096))
+        os.sendfile = sendfile
+
+    def tearDown(self):
+        os.sendfile = self.sendfile
+
+    def spooled(self):
+        out = tempfile.SpooledTemporaryFile(max_size=self.capacity)
+        out.write(self.data)
+        return out
+
+    def test_file_with_content(self):
+        with tempfile.TemporaryFile() as dest:
+            dest.write(b"existing")
+            _copy_to_dest(self.spooled(), dest, self.capacity)
+            self.assertGreater(self.sendfile_calls, 1)
+            self.assertEqual(dest.tell(), 8 + len(self.data))
+            dest.write(b"end")
+            dest.seek(0)
+            self.assertEqual(dest.read(), b"existing" + self.data + b"end")
+
+    def test_bytesio(self):
+        dest = io.BytesIO()
+        _copy_to_dest(self.spooled(), dest, self.capacity)
+        self.assertEqual(self.sendfile_calls, 0)
+        self.assertEqual(dest.getvalue(), self.data)
+
+    def test_pipe(self):
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, "rb") as source:
+            with os.fdopen(write_fd, "wb") as dest:
+                _copy_to_dest(self.spooled(), dest, self.capacity)
+            self.assertEqual(self.sendfile_calls, 0)
+            self.assertEqual(source.read(), self.data)
+
+
+def _rounded(width, height):
+    return int(round(width)), int(round(height))
+
+
+class BackgroundsTestCase(unittest.TestCase):
+    """
+    The first and the last of three A5 pages get test/pdf/background-sample.pdf
+    (an A4 page) as background
+    """
+
+    def setUp(self):
+        self.context = PisaContext(".")
+        self.bg = self.context.get_file(_background)
+        self.bg_reads = 0
+        get_data, get_file = self.bg.get_data, self.bg.get_file
+
+        def count(read):
+            def counted():
+                self.bg_reads += 1
+                return read()
+            return counted
+        self.bg.get_data, self.bg.get_file = count(get_data), count(get_file)
+        self.context.pisaBackgroundList = [self.bg, None, self.bg]
+
+        self.src = io.BytesIO()
+        canvas = Canvas(self.src, pagesize=A5)
+        for _ in range(3):
+            canvas.drawString(100, 100, "Hello World")
+            canvas.showPage()
+        canvas.save()
+        self.src.seek(0)
+
+    @unittest.skipIf(PyPDF2 is None, "PyPDF2 is not installed")
+    def test_pypdf2(self):
+        fitz, document.fitz = document.fitz, None
+        try:
+            dest = io.BytesIO()
+            pisa_add_backgrounds(self.context, self.src, dest)
+        finally:
+            document.fitz = fitz
+        self.assertEqual(self.bg_reads, 1)
+
+        reader = PyPDF2.PdfFileReader(io.BytesIO(dest.getvalue()))
+        self.assertEqual(reader.getNumPages(), 3)
+        bg_box = PyPDF2.PdfFileReader(_background).getPage(0).mediaBox
+        sizes = [_rounded(page.mediaBox.getWidth(), page.mediaBox.getHeight())
+                 for page in (reader.getPage(i) for i in range(3))]
+        self.assertEqual(sizes[0], _rounded(bg_box.getWidth(), bg_box.getHeight()))
+        self.assertEqual(sizes[1], _rounded(*A5))
+        self.assertEqual(sizes[2], sizes[0])
+        # The image of the background ends up in the merged pages only
+        xobjects = ["/XObject" in reader.getPage(i)["/Resources"] for i in range(3)]
+        self.assertEqual(xobjects, [True, False, True])
+
+    @unittest.skipIf(fitz is None, "PyMuPDF is not installed")
+    def test_pymupdf(self):
+        dest = io.BytesIO()
+        pisa_add_backgrounds(self.context, self.src, dest)
+        self.assertEqual(self.bg_reads, 1)
+
+        doc = fitz.open(stream=dest.getvalue(), filetype="pdf")
+        self.assertEqual(doc.page_count, 3)
+        for page in doc:
+            self.assertEqual(_rounded(page.rect.width, page.rect.height), _rounded(*A5))
+        images = [bool(page.get_images()) or bool(page.get_xobjects()) for page in doc]
+        self.assertEqual(images, [True, False, True])
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+from reportlab.lib.colors import red
+from reportlab.lib.pagesizes import landscape, A5
 from xhtml2pdf.parser import pisaParser
 from xhtml2pdf.context import PisaContext
 
@@ -32,6 +34,32 @@ class TestCase(unittest.TestCase):
         r = pisaParser(data, c)
         self.assertEqual(c, r)
 
+    def test_page_size_with_orientation(self):
+        """Asserts '@page {size: a5 landscape}' sets both size and orientation"""
+        c = PisaContext(".")
+        data = b"<style>@page {size: a5 landscape}</style><p>test</p>"
+        pisaParser(data, c)
+        self.assertEqual(c.pageSize, landscape(A5))
+
+    def test_page_border_from_any_side(self):
+        """Asserts the frame border of @page is taken from whichever side is given"""
+        c = PisaContext(".")
+        data = b"<style>@page {border-left-width: 2pt; border-left-color: red}</style><p>test</p>"
+        pisaParser(data, c)
+        border = c.templateList["body"].frames[0].showBoundary
+        self.assertEqual(border.width, 2)
+        self.assertEqual(border.color, red)
+
+    def test_line_break_and_page_count_fragments(self):
+        """Asserts tags adding a fragment without text, and &shy; removal"""
+        c = PisaContext(".")
+        data = b"<p>a&shy;b<br/>c</p><p><pdf:pagecount/></p>"
+        pisaParser(data, c)
+        self.assertEqual(c.err, 0)
+        self.assertEqual(u"".join(frag.text for frag in c.fragList), u"abc")
+        self.assertTrue(any(getattr(frag, "lineBreak", 0) for frag in c.fragList))
+        self.assertTrue(c.fragList[-1].pageCount)
+
 
 def buildTestSuite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -31,6 +31,7 @@ The following Python packages are required for PISA:
 
 Optional packages:
 - PyPDF2 <https://pypi.python.org/pypi/PyPDF2>
+- PyMuPDF <https://pypi.python.org/pypi/PyMuPDF> (faster PDF backgrounds)
 - PIL <http://www.pythonware.com/products/pil/>
 
 """.lstrip()
@@ -29,13 +29,14 @@ from reportlab.lib.styles import ParagraphStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus.frames import Frame, ShowBoundaryValue
-from reportlab.platypus.paraparser import ParaFrag, ps2tt, tt2ps
+from reportlab.platypus.paraparser import ParaFrag, ps2tt
 
 import xhtml2pdf.default
 import xhtml2pdf.parser
 
 from xhtml2pdf.w3c import css
-from xhtml2pdf.util import (get_size, get_coordinates, get_file, PisaFileObject, get_frame_dimensions, get_color)
+from xhtml2pdf.util import (get_size, get_coordinates, get_file, PisaFileObject, get_frame_dimensions, get_color,
+                            get_ps_font_name, memoized)
 from xhtml2pdf.xhtml2pdf_reportlab import (PmlPageTemplate, PmlTableOfContents, PmlParagraph, PmlParagraphAndImage,
                                            PmlPageCount)
 
@@ -55,15 +56,37 @@ superFraction = 0.4
 NBSP = u"\u00a0"
 ListType = (list, tuple)
 
+# Separators are kept in the result of split() by the capturing groups
+_eol_re = re.compile(r'(\r\n|\n|\r)')
+_space_re = re.compile(r'(\ )')
+_nbsp_re = re.compile(u'(' + NBSP + u')')
+_whitespace_re = re.compile(r'\s+', re.UNICODE)
+
+_SENTINEL = object()
+
+# Frame borders take the first of these properties given in @page/@frame
+BORDER_COLOR_ATTRS = ('border-top-color', 'border-bottom-color', 'border-left-color', 'border-right-color')
+BORDER_WIDTH_ATTRS = ('border-top-width', 'border-bottom-width', 'border-left-width', 'border-right-width')
+
+# Parsed default style sheets by their source, see PisaContext.parse_css
+_DEFAULT_CSS_CACHE = {}
+
+# Font file extensions handled by PisaContext.load_font
+TTF_SUFFIXES = frozenset(("ttc", "ttf"))
+TYPE1_SUFFIXES = frozenset(("afm", "pfb"))
+# (bold, italic) combinations a font family is mapped for
+FONT_STYLES = ((0, 0), (0, 1), (1, 0), (1, 1))
+
 
 def clone(self, **kwargs):
-    n = ParaFrag(**self.__dict__)
+    # Copy the attribute dict directly instead of passing it through
+    # ParaFrag.__init__ as keyword arguments
+    n = self.__class__()
+    d = n.__dict__ = self.__dict__.copy()
     if kwargs:
-        d = n.__dict__
         d.update(kwargs)
         # This else could cause trouble in Paragraphs with images etc.
-        if "cbDefn" in d:
-            del d["cbDefn"]
+        d.pop("cbDefn", None)
     n.bulletText = None
     return n
 
@@ -71,100 +94,150 @@ def clone(self, **kwargs):
 ParaFrag.clone = clone
 
 
+# Attributes every fragment carries itself. ReportLab tests some of them
+# with hasattr(), e.g. "text" tells text fragments from word lists.
+_FRAG_TEMPLATE = dict(
+    sub=0,
+    super=0,
+    rise=0,
+    underline=0,  # XXX Need to be able to set color to fit CSS tests
+    strike=0,
+    greek=0,
+    link=None,
+    text="",
+)
+
+# Defaults that are only stored on a fragment once CSS changes them, until
+# then they are looked up here by _PisaParaFrag.__getattr__. This keeps the
+# dict copied by clone() small.
+_FRAG_DEFAULTS = dict(
+    # Extras
+    leading=0,
+    letterSpacing="normal",
+    leadingSource="150%",
+    leadingSpace=0,
+    backColor=None,
+    spaceBefore=0,
+    spaceAfter=0,
+    leftIndent=0,
+    rightIndent=0,
+    firstLineIndent=0,
+    keepWithNext=False,
+    alignment=TA_LEFT,
+    vAlign=None,
+
+    borderWidth=1,
+    borderStyle=None,
+    borderPadding=0,
+    borderColor=None,
+
+    borderLeftWidth=1,
+    borderLeftColor=None,
+    borderLeftStyle=None,
+    borderRightWidth=1,
+    borderRightColor=None,
+    borderRightStyle=None,
+    borderTopWidth=1,
+    borderTopColor=None,
+    borderTopStyle=None,
+    borderBottomWidth=1,
+    borderBottomColor=None,
+    borderBottomStyle=None,
+
+    paddingLeft=0,
+    paddingRight=0,
+    paddingTop=0,
+    paddingBottom=0,
+
+    listStyleType=None,
+    listStyleImage=None,
+    whiteSpace="normal",
+
+    wordWrap=None,
+
+    pageNumber=False,
+    pageCount=False,
+    height=None,
+    width=None,
+
+    bulletIndent=0,
+    bulletText=None,
+    bulletFontName="Helvetica",
+
+    zoom=1.0,
+
+    outline=False,
+    outlineLevel=0,
+    outlineOpen=False,
+
+    insideStaticFrame=0,
+)
+
+
+class _PisaParaFrag(ParaFrag):
+    """
+    Fragment created by xhtml2pdf, falls back to _FRAG_DEFAULTS for unset
+    attributes. ReportLab's own ParaFrag keeps its getattr() defaults.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return _FRAG_DEFAULTS[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
 def get_paragraph_fragment(style):
-    frag = ParaFrag()
-    frag.sub = 0
-    frag.super = 0
-    frag.rise = 0
-    frag.underline = 0  # XXX Need to be able to set color to fit CSS tests
-    frag.strike = 0
-    frag.greek = 0
-    frag.link = None
-    frag.text = ""
-    frag.fontName = "Times-Roman"
+    frag = _PisaParaFrag(**_FRAG_TEMPLATE)
     frag.fontName, frag.bold, frag.italic = ps2tt(style.fontName)
     frag.fontSize = style.fontSize
     frag.textColor = style.textColor
+    return frag
 
-    # Extras
-    frag.leading = 0
-    frag.letterSpacing = "normal"
-    frag.leadingSource = "150%"
-    frag.leadingSpace = 0
-    frag.backColor = None
-    frag.spaceBefore = 0
-    frag.spaceAfter = 0
-    frag.leftIndent = 0
-    frag.rightIndent = 0
-    frag.firstLineIndent = 0
-    frag.keepWithNext = False
-    frag.alignment = TA_LEFT
-    frag.vAlign = None
-
-    frag.borderWidth = 1
-    frag.borderStyle = None
-    frag.borderPadding = 0
-    frag.borderColor = None
-
-    frag.borderLeftWidth = frag.borderWidth
-    frag.borderLeftColor = frag.borderColor
-    frag.borderLeftStyle = frag.borderStyle
-    frag.borderRightWidth = frag.borderWidth
-    frag.borderRightColor = frag.borderColor
-    frag.borderRightStyle = frag.borderStyle
-    frag.borderTopWidth = frag.borderWidth
-    frag.borderTopColor = frag.borderColor
-    frag.borderTopStyle = frag.borderStyle
-    frag.borderBottomWidth = frag.borderWidth
-    frag.borderBottomColor = frag.borderColor
-    frag.borderBottomStyle = frag.borderStyle
-
-    frag.paddingLeft = 0
-    frag.paddingRight = 0
-    frag.paddingTop = 0
-    frag.paddingBottom = 0
-
-    frag.listStyleType = None
-    frag.listStyleImage = None
-    frag.whiteSpace = "normal"
-
-    frag.wordWrap = None
-
-    frag.pageNumber = False
-    frag.pageCount = False
-    frag.height = None
-    frag.width = None
-
-    frag.bulletIndent = 0
-    frag.bulletText = None
-    frag.bulletFontName = "Helvetica"
-
-    frag.zoom = 1.0
-
-    frag.outline = False
-    frag.outlineLevel = 0
-    frag.outlineOpen = False
-
-    frag.insideStaticFrame = 0
 
-    return frag
+def _has_url_scheme(path):
+    # A scheme always ends with a colon, skip urlparse for plain paths
+    return ":" in path and bool(urlparse.urlparse(path).scheme)
 
 
 def get_dir_name(path):
-    parts = urlparse.urlparse(path)
-    if parts.scheme:
+    if _has_url_scheme(path):
         return path
     else:
         return os.path.dirname(os.path.abspath(path))
 
 
+def _strip_css_markup(value):
+    """
+    Remove the CDATA section or HTML comment that may wrap a style sheet
+    """
+    value = value.strip()
+    if value.startswith("<![CDATA["):
+        value = value[9: - 3]
+    elif not value.startswith("<!--"):
+        # Already stripped, nothing else to remove
+        return value
+    if value.startswith("<!--"):
+        value = value[4: - 3]
+    return value.strip()
+
+
+@memoized
+def _font_keys(names):
+    """
+    Lookup keys of a comma separated list of font names
+    """
+    if not isinstance(names, text_type):
+        names = str(names)
+    return tuple(name.strip().lower() for name in names.strip().split(","))
+
+
 class PisaCSSBuilder(css.CSSBuilder):
     def at_font_face(self, declarations):
         """
         Embed fonts
         """
-        result = self.ruleset([self.selector('*')], declarations)
-        data = result[0].values()[0]
+        data = self._at_rule_data(declarations)
         if "src" not in data:
             # invalid - source is required, ignore this specification
             return {}, {}
@@ -187,35 +260,44 @@ class PisaCSSBuilder(css.CSSBuilder):
             italic=italic)
         return {}, {}
 
+    def _at_rule_data(self, declarations):
+        """
+        Normal (not !important) declarations of an at-rule as a dict, the
+        ruleset is empty if there are none
+        """
+        result = self.ruleset([self.selector('*')], declarations)
+        return next(iter(result[0].values()), {})
+
     def _pisa_add_frame(self, name, data, first=False, border=None, size=(0, 0)):
         c = self.c
+        get = data.get
         if not name:
             name = "-pdf-frame-%d" % c.uid()
-        if data.get('is_landscape', False):
+        if get('is_landscape', False):
             size = (size[1], size[0])
         x, y, w, h = get_frame_dimensions(data, size[0], size[1])
         # print name, x, y, w, h
         #if not (w and h):
         #    return None
+        border = get("-pdf-frame-border", border)
         if first:
-            return name, None, data.get("-pdf-frame-border", border), x, y, w, h, data
+            return name, None, border, x, y, w, h, data
 
-        return (name, data.get("-pdf-frame-content", None),
-                data.get("-pdf-frame-border", border), x, y, w, h, data)
+        return name, get("-pdf-frame-content", None), border, x, y, w, h, data
 
     def _get_from_data(self, data, attr, default=None, func=None):
-        if not func:
-            func = lambda x: x
-
-        if type(attr) in (list, tuple):
-            for a in attr:
-                if a in data:
-                    return func(data[a])
-                return default
-        else:
-            if attr in data:
-                return func(data[attr])
-            return default
+        """
+        Value of `attr` in `data` passed through `func`. If `attr` is a list
+        the first of its names found in `data` is used.
+        """
+        if not isinstance(attr, ListType):
+            attr = (attr,)
+        get = data.get
+        for a in attr:
+            value = get(a, _SENTINEL)
+            if value is not _SENTINEL:
+                return func(value) if func else value
+        return default
 
     def at_page(self, name, pseudopage, declarations):
         c = self.c
@@ -224,14 +306,8 @@ class PisaCSSBuilder(css.CSSBuilder):
         page_border = None
 
         if declarations:
-            result = self.ruleset([self.selector('*')], declarations)
-
-            if declarations:
-                try:
-                    data = result[0].values()[0]
-                except Exception:
-                    data = result[0].popitem()[1]
-                page_border = data.get("-pdf-frame-border", None)
+            data = self._at_rule_data(declarations)
+            page_border = data.get("-pdf-frame-border", None)
 
         if name in c.templateList:
             log.warn(self.c.warning("template '%s' has already been defined", name))
@@ -242,7 +318,8 @@ class PisaCSSBuilder(css.CSSBuilder):
         is_landscape = False
         if "size" in data:
             size = data["size"]
-            if type(size) is not ListType:
+            # A single dimension is a (value, unit) tuple, only lists hold several values
+            if not isinstance(size, list):
                 size = [size]
             size_list = []
             for value in size:
@@ -263,14 +340,13 @@ class PisaCSSBuilder(css.CSSBuilder):
             if is_landscape:
                 c.pageSize = landscape(c.pageSize)
 
-        padding_top = self._get_from_data(data, 'padding-top', 0, get_size)
-        padding_left = self._get_from_data(data, 'padding-left', 0, get_size)
-        padding_right = self._get_from_data(data, 'padding-right', 0, get_size)
-        padding_bottom = self._get_from_data(data, 'padding-bottom', 0, get_size)
-        border_color = self._get_from_data(data, ('border-top-color', 'border-bottom-color', 'border-left-color',
-                                                  'border-right-color'), None, get_color)
-        border_width = self._get_from_data(data, ('border-top-width', 'border-bottom-width', 'border-left-width',
-                                                  'border-right-width'), 0, get_size)
+        get_from_data = self._get_from_data
+        padding_top = get_from_data(data, 'padding-top', 0, get_size)
+        padding_left = get_from_data(data, 'padding-left', 0, get_size)
+        padding_right = get_from_data(data, 'padding-right', 0, get_size)
+        padding_bottom = get_from_data(data, 'padding-bottom', 0, get_size)
+        border_color = get_from_data(data, BORDER_COLOR_ATTRS, None, get_color)
+        border_width = get_from_data(data, BORDER_WIDTH_ATTRS, 0, get_size)
 
         for prop in ("margin-top", "margin-left", "margin-right", "margin-bottom",
                      "top", "left", "right", "bottom", "width", "height"):
@@ -281,15 +357,15 @@ class PisaCSSBuilder(css.CSSBuilder):
         # Frames have to be calculated after we know the pagesize
         frame_list = []
         static_list = []
+        page_size = c.pageSize
+        page_width, page_height = page_size
         for fname, static, border, x, y, w, h, fdata in c.frameList:
-            fpadding_top = self._get_from_data(fdata, 'padding-top', padding_top, get_size)
-            fpadding_left = self._get_from_data(fdata, 'padding-left', padding_left, get_size)
-            fpadding_right = self._get_from_data(fdata, 'padding-right', padding_right, get_size)
-            fpadding_bottom = self._get_from_data(fdata, 'padding-bottom', padding_bottom, get_size)
-            fborder_color = self._get_from_data(fdata, ('border-top-color', 'border-bottom-color', 'border-left-color',
-                                                        'border-right-color'), border_color, get_color)
-            fborder_width = self._get_from_data(fdata, ('border-top-width', 'border-bottom-width', 'border-left-width',
-                                                        'border-right-width'), border_width, get_size)
+            fpadding_top = get_from_data(fdata, 'padding-top', padding_top, get_size)
+            fpadding_left = get_from_data(fdata, 'padding-left', padding_left, get_size)
+            fpadding_right = get_from_data(fdata, 'padding-right', padding_right, get_size)
+            fpadding_bottom = get_from_data(fdata, 'padding-bottom', padding_bottom, get_size)
+            fborder_color = get_from_data(fdata, BORDER_COLOR_ATTRS, border_color, get_color)
+            fborder_width = get_from_data(fdata, BORDER_WIDTH_ATTRS, border_width, get_size)
 
             if border or page_border:
                 frame_border = ShowBoundaryValue()
@@ -298,8 +374,8 @@ class PisaCSSBuilder(css.CSSBuilder):
 
             #fix frame sizing problem.
             if static:
-                x, y, w, h = get_frame_dimensions(fdata, c.pageSize[0], c.pageSize[1])
-            x, y, w, h = get_coordinates(x, y, w, h, c.pageSize)
+                x, y, w, h = get_frame_dimensions(fdata, page_width, page_height)
+            x, y, w, h = get_coordinates(x, y, w, h, page_size)
             if w <= 0 or h <= 0:
                 log.warn(self.c.warning("Negative width or height of frame. Check @frame definitions."))
 
@@ -367,15 +443,8 @@ class PisaCSSBuilder(css.CSSBuilder):
 
     def at_frame(self, name, declarations):
         if declarations:
-            result = self.ruleset([self.selector('*')], declarations)
-            # print "@BOX", name, declarations, result
-
-            data = result[0]
+            data = self._at_rule_data(declarations)
             if data:
-                try:
-                    data = data.values()[0]
-                except Exception:
-                    data = data.popitem()[1]
                 self.c.frameList.append(
                     self._pisa_add_frame(name, data, size=self.c.pageSize))
 
@@ -389,7 +458,7 @@ class PisaCSSParser(css.CSSParser):
         cssFile = self.c.get_file(cssResourceName, relative=self.rootPath)
         if not cssFile:
             return None
-        if self.rootPath and urlparse.urlparse(self.rootPath).scheme:
+        if self.rootPath and _has_url_scheme(self.rootPath):
             self.rootPath = urlparse.urljoin(self.rootPath, cssResourceName)
         else:
             self.rootPath = get_dir_name(cssFile.uri)
@@ -405,8 +474,33 @@ class PisaContext(object):
     various data.
     """
 
+    # A context is touched for every fragment of the document, fixed slots
+    # avoid a per-instance __dict__ and make attribute access cheaper
+    __slots__ = (
+        # document
+        "fontList", "path", "capacity", "node", "toc", "story", "indexing_story", "text",
+        "log", "err", "warn", "uidctr", "multiBuild", "meta", "dest",
+        # pages and frames
+        "pageSize", "template", "templateList", "frameList", "frameStatic", "frameStaticList",
+        "pisaBackgroundList", "keepInFrameIndex",
+        # fragments and paragraphs
+        "baseFontSize", "fontSize", "anchorFrag", "anchorName", "tableData", "frag", "fragBlock",
+        "fragList", "fragAnchor", "fragStack", "fragStrip", "listCounter", "image", "imageData",
+        "force", "select_options",
+        # paths
+        "path_callback", "pathDocument", "pathDirectory",
+        # CSS
+        "cssText", "cssDefaultText", "CSSBuilder", "CSSParser", "css", "cssDefault", "cssCascade",
+        "cssAttr",
+        # parse_css hands out weak references to the context
+        "__weakref__",
+    )
+
     def __init__(self, path, debug=0, capacity=-1):
-        self.fontList = copy.copy(xhtml2pdf.default.DEFAULT_FONT)
+        # Font mappings may have changed since the last document
+        get_ps_font_name.cache_clear()
+
+        self.fontList = xhtml2pdf.default.DEFAULT_FONT.copy()
         self.path = []
         self.capacity = capacity
 
@@ -436,11 +530,13 @@ class PisaContext(object):
         self.baseFontSize = get_size("12pt")
 
         self.anchorFrag = []
-        self.anchorName = []
+        self.anchorName = set()
 
         self.tableData = None
 
-        self.frag = self.fragBlock = get_paragraph_fragment(ParagraphStyle('default%d' % self.uid()))
+        self.frag = get_paragraph_fragment(ParagraphStyle('default%d' % self.uid()))
+        # push_fragment() modifies self.frag in place, keep the block style apart
+        self.fragBlock = copy.copy(self.frag)
         self.fragList = []
         self.fragAnchor = []
         self.fragStack = []
@@ -459,8 +555,7 @@ class PisaContext(object):
 
         # Store path to document
         self.pathDocument = path or "__dummy__"
-        parts = urlparse.urlparse(self.pathDocument)
-        if not parts.scheme:
+        if not _has_url_scheme(self.pathDocument):
             self.pathDocument = os.path.abspath(self.pathDocument)
         self.pathDirectory = get_dir_name(self.pathDocument)
 
@@ -480,21 +575,11 @@ class PisaContext(object):
 
     # METHODS FOR CSS
     def add_css(self, value):
-        value = value.strip()
-        if value.startswith("<![CDATA["):
-            value = value[9: - 3]
-        if value.startswith("<!--"):
-            value = value[4: - 3]
-        self.cssText += value.strip() + "\n"
+        self.cssText += _strip_css_markup(value) + "\n"
 
     # METHODS FOR CSS
     def add_default_css(self, value):
-        value = value.strip()
-        if value.startswith("<![CDATA["):
-            value = value[9: - 3]
-        if value.startswith("<!--"):
-            value = value[4: - 3]
-        self.cssDefaultText += value.strip() + "\n"
+        self.cssDefaultText += _strip_css_markup(value) + "\n"
 
     def parse_css(self):
         # This self-reference really should be refactored. But for now
@@ -503,17 +588,25 @@ class PisaContext(object):
         # 2.7.3) isn't aggressive enough.
         import weakref
 
+        context = weakref.proxy(self)
+
         self.CSSBuilder = PisaCSSBuilder(mediumSet=["all", "print", "pdf"])
-        self.CSSBuilder._c = weakref.ref(self)
-        PisaCSSBuilder.c = property(lambda self: self._c())
+        self.CSSBuilder.c = context
 
         self.CSSParser = PisaCSSParser(self.CSSBuilder)
         self.CSSParser.rootPath = self.pathDirectory
-        self.CSSParser._c = weakref.ref(self)
-        PisaCSSParser.c = property(lambda self: self._c())
+        self.CSSParser.c = context
 
         self.css = self.CSSParser.parse(self.cssText)
-        self.cssDefault = self.CSSParser.parse(self.cssDefaultText)
+        self.cssDefault = _DEFAULT_CSS_CACHE.get(self.cssDefaultText)
+        if self.cssDefault is None:
+            self.cssDefault = self.CSSParser.parse(self.cssDefaultText)
+            if "@" not in self.cssDefaultText:
+                # Without at-rules parsing has no side effects on the
+                # context, so the result can be shared by all documents
+                if len(_DEFAULT_CSS_CACHE) >= 16:
+                    _DEFAULT_CSS_CACHE.clear()
+                _DEFAULT_CSS_CACHE[self.cssDefaultText] = self.cssDefault
         self.cssCascade = css.CSSCascadeStrategy(userAgent=self.cssDefault, user=self.css)
         self.cssCascade.parser = self.CSSParser
 
@@ -580,7 +673,7 @@ class PisaContext(object):
         style.paddingBottom = first.paddingBottom
         style.paddingLeft = first.paddingLeft
         style.paddingRight = first.paddingRight
-        style.fontName = tt2ps(first.fontName, first.bold, first.italic)
+        style.fontName = get_ps_font_name(first.fontName, first.bold, first.italic)
 
         return style
 
@@ -607,22 +700,11 @@ class PisaContext(object):
             self.indexing_story = PmlPageCount()
             self.multiBuild = True
 
-    def dump_paragraph(self, frags, style):
-        return
-
     def add_paragraph(self, force=False):
 
         force = (force or self.force)
         self.force = False
 
-        # Cleanup the trail
-        try:
-            rfragList = reversed(self.fragList)
-        except:
-            # For Python 2.3 compatibility
-            rfragList = copy.copy(self.fragList)
-            rfragList.reverse()
-
         # Find maximum lead
         maxLeading = 0
         #fontSize = 0
@@ -646,7 +728,7 @@ class PisaContext(object):
             first.bulletText = None
 
             # Add paragraph to story
-            if force or len(self.fragAnchor + self.fragList) > 0:
+            if force or self.fragAnchor or self.fragList:
 
                 # We need this empty fragment to work around problems in
                 # Reportlab paragraphs regarding backGround etc.
@@ -658,11 +740,12 @@ class PisaContext(object):
                     blank.text = ''
                     self.fragList.append(blank)
 
-                self.dump_paragraph(self.fragAnchor + self.fragList, style)
+                # A new list, clear_fragment() reuses self.fragList
+                frags = self.fragAnchor + self.fragList
                 para = PmlParagraph(
                     self.text,
                     style,
-                    frags=self.fragAnchor + self.fragList,
+                    frags=frags,
                     bulletText=bulletText)
 
                 para.outline = first.outline
@@ -691,7 +774,8 @@ class PisaContext(object):
 
     # METHODS FOR FRAG
     def clear_fragment(self):
-        self.fragList = []
+        # Reuse the list, add_paragraph hands a concatenated copy to the paragraph
+        del self.fragList[:]
         self.fragStrip = True
         self.text = u""
 
@@ -708,7 +792,7 @@ class PisaContext(object):
         self.fragList.append(frag)
 
     # XXX Argument frag is useless!
-    def add_fragment(self, text="", frag=None):
+    def add_fragment(self, text=u"", frag=None):
 
         frag = baseFrag = self.frag.clone()
 
@@ -726,60 +810,74 @@ class PisaContext(object):
             frag.fontSize = max(frag.fontSize - sizeDelta, 3)
 
        # bold, italic, and underline
-        frag.fontName = frag.bulletFontName = tt2ps(frag.fontName, frag.bold, frag.italic)
+        frag.fontName = frag.bulletFontName = get_ps_font_name(frag.fontName, frag.bold, frag.italic)
 
         # Replace &shy; with empty and normalize NBSP
-        text = (text
-                .replace(u"\xad", u"")
-                .replace(u"\xc2\xa0", NBSP)
-                .replace(u"\xa0", NBSP))
+        if u"\xad" in text:
+            text = text.replace(u"\xad", u"")
+        if u"\xc2\xa0" in text:
+            # UTF-8 encoded NBSP that was decoded as latin-1
+            text = text.replace(u"\xc2\xa0", NBSP)
+
+        # Bind what the loops below call for every piece of text
+        clone = baseFrag.clone
+        append = self._append_fragment
+        texts = []
 
         if frag.whiteSpace == "pre":
 
             # Handle by lines
-            for text in re.split(r'(\r\n|\n|\r)', text):
+            for text in _eol_re.split(text):
                 # This is an exceptionally expensive piece of code
-                self.text += text
+                texts.append(text)
                 if ("\n" in text) or ("\r" in text):
                     # If EOL insert a linebreak
-                    frag = baseFrag.clone()
+                    frag = clone()
                     frag.text = ""
                     frag.lineBreak = 1
-                    self._append_fragment(frag)
+                    append(frag)
                 else:
                     # Handle tabs in a simple way
                     text = text.replace(u"\t", 8 * u" ")
                     # Somehow for Reportlab NBSP have to be inserted
                     # as single character fragments
-                    for text in re.split(r'(\ )', text):
-                        frag = baseFrag.clone()
+                    for text in _space_re.split(text):
+                        frag = clone()
                         if text == " ":
                             text = NBSP
                         frag.text = text
-                        self._append_fragment(frag)
+                        append(frag)
         else:
-            for text in re.split(u'(' + NBSP + u')', text):
-                frag = baseFrag.clone()
+            for text in _nbsp_re.split(text):
+                frag = clone()
                 if text == NBSP:
                     self.force = True
                     frag.text = NBSP
-                    self.text += text
-                    self._append_fragment(frag)
+                    texts.append(text)
+                    append(frag)
                 else:
-                    frag.text = " ".join(("x" + text + "x").split())[1: - 1]
+                    # Collapse whitespace runs, keeping a single leading/trailing space
+                    frag.text = _whitespace_re.sub(u" ", text)
                     if self.fragStrip:
                         frag.text = frag.text.lstrip()
                         if frag.text:
                             self.fragStrip = False
-                    self.text += frag.text
-                    self._append_fragment(frag)
+                    texts.append(frag.text)
+                    append(frag)
+
+        self.text += u"".join(texts)
 
     def push_fragment(self):
-        self.fragStack.append(self.frag)
-        self.new_fragment()
+        # Save a snapshot of the current style instead of stacking a clone,
+        # self.frag stays the same object while the element is processed
+        frag = self.frag
+        self.fragStack.append(frag.__dict__.copy())
+        frag.bulletText = None
 
     def pull_fragment(self):
-        self.frag = self.fragStack.pop()
+        d = self.frag.__dict__
+        d.clear()
+        d.update(self.fragStack.pop())
 
     # XXX
     def _get_fragment(self, l=20):
@@ -846,26 +944,41 @@ class PisaContext(object):
         Name of a font
         """
         # print names, self.fontList
-        if not isinstance(names, ListType):
-            if not isinstance(names, text_type):
-                names = str(names)
-            names = names.strip().split(",")
-        for name in names:
-            if not isinstance(name, text_type):
-                name = str(name)
-            font = self.fontList.get(name.strip().lower(), None)
+        if isinstance(names, ListType):
+            keys = [(name if isinstance(name, text_type) else str(name)).strip().lower() for name in names]
+        else:
+            keys = _font_keys(names)
+        get = self.fontList.get
+        for key in keys:
+            font = get(key)
             if font is not None:
                 return font
-        return self.fontList.get(default, None)
+        return get(default)
 
     def register_font(self, fontname, alias=None):
-        if alias is None:
-            alias = []
-        self.fontList[str(fontname).lower()] = str(fontname)
-        for a in alias:
-            if not isinstance(fontname, text_type):
-                fontname = str(fontname)
-            self.fontList[str(a)] = fontname
+        """
+        Register a font and its aliases. Names that are not text are
+        converted with str() once, keys are lowercased (aliases also
+        stripped) so looking them up needs no further conversion. Every key
+        maps to the same font name.
+        """
+        if not isinstance(fontname, text_type):
+            fontname = str(fontname)
+        font_list = self.fontList
+        font_list[fontname.lower()] = fontname
+        if alias:
+            font_list.update(((a if isinstance(a, text_type) else str(a)).strip().lower(), fontname)
+                             for a in alias)
+
+    def _add_font_mappings(self, font_name, style_names, target):
+        """
+        Map the styles of font_name that were not embedded yet to target
+        """
+        font_list = self.fontList
+        for (style_bold, style_italic), style_name in zip(FONT_STYLES, style_names):
+            if style_name not in font_list:
+                addMapping(font_name, style_bold, style_italic, target)
+        get_ps_font_name.cache_clear()
 
     def load_font(self, names, src, encoding="WinAnsiEncoding", bold=0, italic=0):
 
@@ -875,25 +988,25 @@ class PisaContext(object):
             file = src
             src = file.uri
 
-            log.debug("Load font %r", src)
-
-            if type(names) is ListType:
-                font_alias = names
-            else:
-                font_alias = (x.lower().strip() for x in names.split(",") if x)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Load font %r", src)
 
             # XXX Problems with unicode here
-            font_alias = [str(x) for x in font_alias]
+            if isinstance(names, ListType):
+                font_alias = [str(x) for x in names]
+            else:
+                font_alias = [str(x) for x in (x.strip().lower() for x in names.split(",")) if x]
 
             font_name = font_alias[0]
-            parts = src.split(".")
-            base_name, suffix = ".".join(parts[: - 1]), parts[- 1]
-            suffix = suffix.lower()
+            base_name, suffix = os.path.splitext(src)
+            suffix = suffix[1:].lower()
 
-            if suffix in ["ttc", "ttf"]:
+            # Names of the styles in FONT_STYLES order, full_font_name is the
+            # one for the weight and style of this file
+            style_names = tuple("%s_%d%d" % (font_name, b, i) for b, i in FONT_STYLES)
+            full_font_name = style_names[2 * bold + italic]
 
-                # determine full font name according to weight and style
-                full_font_name = "%s_%d%d" % (font_name, bold, italic)
+            if suffix in TTF_SUFFIXES:
 
                 # check if font has already been registered
                 if full_font_name in self.fontList:
@@ -905,15 +1018,12 @@ class PisaContext(object):
                     pdfmetrics.registerFont(TTFont(full_font_name, filename))
 
                     # Add or replace missing styles
-                    for bold in (0, 1):
-                        for italic in (0, 1):
-                            if ("%s_%d%d" % (font_name, bold, italic)) not in self.fontList:
-                                addMapping(font_name, bold, italic, full_font_name)
+                    self._add_font_mappings(font_name, style_names, full_font_name)
 
                     # Register "normal" name and the place holder for style
                     self.register_font(font_name, font_alias + [full_font_name])
 
-            elif suffix in ("afm", "pfb"):
+            elif suffix in TYPE1_SUFFIXES:
 
                 if suffix == "afm":
                     afm = file.get_named_file()
@@ -924,9 +1034,6 @@ class PisaContext(object):
                     tfile = PisaFileObject(base_name + ".afm")
                     afm = tfile.get_named_file()
 
-                # determine full font name according to weight and style
-                full_font_name = "%s_%d%d" % (font_name, bold, italic)
-
                 # check if font has already been registered
                 if full_font_name in self.fontList:
                     log.warn(self.warning("Repeated font embed for %s, skip new embed", font_name))
@@ -941,10 +1048,7 @@ class PisaContext(object):
                     pdfmetrics.registerFont(just_font)
 
                     # Add or replace missing styles
-                    for bold in (0, 1):
-                        for italic in (0, 1):
-                            if ("%s_%d%d" % (font_name, bold, italic)) not in self.fontList:
-                                addMapping(font_name, bold, italic, font_name_original)
+                    self._add_font_mappings(font_name, style_names, font_name_original)
 
                     # Register "normal" name and the place holder for style
                     self.register_font(font_name, font_alias + [full_font_name, font_name_original])
@@ -14,36 +14,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import cgi
 import logging
+import os
+import shutil
 
-from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from tempfile import SpooledTemporaryFile
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
 
 from xhtml2pdf.context import PisaContext
 from xhtml2pdf.default import DEFAULT_CSS
 from xhtml2pdf.parser import pisaParser
 from xhtml2pdf.xhtml2pdf_reportlab import PmlBaseDoc, PmlPageTemplate
-from xhtml2pdf.util import PisaTempFile, get_box, PyPDF2
+from xhtml2pdf.util import get_box, PyPDF2, fitz
 
 from reportlab.platypus.flowables import Spacer
 from reportlab.platypus.frames import Frame
 
 log = logging.getLogger("xhtml2pdf")
 
+# Chunk size used to stream the rendered PDF into the caller's dest
+COPY_BUFSIZE = 64 * 1024
+
 
 def pisa_error_document(dest, c):
-    out = PisaTempFile(capacity=c.capacity)
-    out.write("<p style='background-color:red;'><strong>%d error(s) occured:</strong><p>" % c.err)
+    # Errors go straight into the document, warnings are appended after
+    # their heading once all entries are known
+    parts = ["<p style='background-color:red;'><strong>%d error(s) occured:</strong><p>" % c.err]
+    warnings = ["<p><strong>%d warning(s) occured:</strong><p>" % c.warn]
     for mode, line, msg, _ in c.log:
         if mode == "error":
-            out.write("<pre>%s in line %d: %s</pre>" % (mode, line, cgi.escape(msg)))
-
-    out.write("<p><strong>%d warning(s) occured:</strong><p>" % c.warn)
-    for mode, line, msg, _ in c.log:
-        if mode == "warning":
-            out.write("<p>%s in line %d: %s</p>" % (mode, line, cgi.escape(msg)))
-
-    return pisa_document(out.getvalue(), dest, raise_exception=False)
+            parts.append("<pre>%s in line %d: %s</pre>" % (mode, line, escape(msg, False)))
+        elif mode == "warning":
+            warnings.append("<p>%s in line %d: %s</p>" % (mode, line, escape(msg, False)))
+    parts.extend(warnings)
+    return pisa_document("".join(parts), dest, raise_exception=False)
 
 
 def pisa_story(src, path=None, link_callback=None, debug=0, default_css=None, xhtml=False, encoding=None, context=None,
@@ -74,22 +82,116 @@ def pisa_story(src, path=None, link_callback=None, debug=0, default_css=None, xh
     return context
 
 
+def _background_pdf(context, backgrounds, ctr):
+    """
+    The background of page `ctr` if it is a PDF that can be merged
+    """
+    bg = backgrounds[ctr] if ctr < len(backgrounds) else None
+    if bg and not bg.not_found() and bg.mimetype == "application/pdf":
+        return bg
+    if bg:
+        log.warn(context.warning("Background PDF %s doesn't exist.", bg))
+    return None
+
+
+def pisa_add_backgrounds(context, src, dest):
+    """
+    Put the PDF backgrounds collected while building the document underneath
+    the pages of the PDF in `src` and write the result to `dest`. PyMuPDF is
+    used when it is installed, PyPDF2 otherwise.
+
+    The backends differ in the size of a page that gets a background: PyPDF2
+    gives it the MediaBox of the background, PyMuPDF keeps the box of the
+    page and scales the background into it.
+    """
+    if fitz is not None:
+        _add_backgrounds_fitz(context, src, dest)
+    else:
+        _add_backgrounds_pypdf2(context, src, dest)
+
+
+def _add_backgrounds_fitz(context, src, dest):
+    src.seek(0)
+    doc = fitz.open(stream=src.read(), filetype="pdf")
+    backgrounds = context.pisaBackgroundList
+    bg_docs = {}
+    for ctr, page in enumerate(doc):
+        bg = _background_pdf(context, backgrounds, ctr)
+        if bg is not None:
+            bgdoc = bg_docs.get(bg)
+            if bgdoc is None:
+                bgdoc = bg_docs[bg] = fitz.open(stream=bg.get_data(), filetype="pdf")
+            page.show_pdf_page(page.rect, bgdoc, 0, overlay=False)
+    doc.save(dest, garbage=3, deflate=True)
+
+
+def _add_backgrounds_pypdf2(context, src, dest):
+    output = PyPDF2.PdfFileWriter()
+    input1 = PyPDF2.PdfFileReader(src)
+    backgrounds = context.pisaBackgroundList
+    # Each background PDF is only read once, its first page is never
+    # modified so it can be reused for every page it belongs to
+    bg_pages = {}
+    for ctr in range(input1.getNumPages()):
+        page = input1.getPage(ctr)
+        bg = _background_pdf(context, backgrounds, ctr)
+        if bg is not None:
+            pagebg = bg_pages.get(bg)
+            if pagebg is None:
+                pagebg = bg_pages[bg] = PyPDF2.PdfFileReader(bg.get_file()).getPage(0)
+            merged = PyPDF2.pdf.PageObject.createBlankPage(
+                None, pagebg.mediaBox.getWidth(), pagebg.mediaBox.getHeight())
+            merged.mergePage(pagebg)
+            merged.mergePage(page)
+            page = merged
+        output.addPage(page)
+    output.write(dest)
+
+
+def _copy_to_dest(out, dest, capacity):
+    """
+    Copy the rendered PDF in `out` to the file object `dest`. A document that
+    was bigger than `capacity` is already on disk, if `dest` is a real file
+    too the kernel copies it with os.sendfile.
+    """
+    size = out.tell()
+    out.seek(0)
+    if size > capacity and hasattr(os, "sendfile"):
+        try:
+            dest.flush()
+            out_fd, dest_fd = out.fileno(), dest.fileno()
+            start = dest.tell()
+            sent = os.sendfile(dest_fd, out_fd, 0, size)
+        except (AttributeError, OSError, ValueError):
+            # Not a real file or not supported by the platform
+            pass
+        else:
+            while 0 < sent < size:
+                sent += os.sendfile(dest_fd, out_fd, sent, size - sent)
+            # Keep the position of the file object in line with the fd
+            dest.seek(start + size)
+            return
+    shutil.copyfileobj(out, dest, COPY_BUFSIZE)
+
+
 def pisa_document(src, dest=None, path=None, link_callback=None, debug=0, default_css=None, xhtml=False, encoding=None,
                   xml_output=None, raise_exception=True, capacity=100 * 1024, **kwargs):
-    log.debug("pisaDocument options:\n  src = %r\n  dest = %r\n  path = %r\n  link_callback = %r\n  xhtml = %r",
-              src, dest, path, link_callback, xhtml)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("pisaDocument options:\n  src = %r\n  dest = %r\n  path = %r\n  link_callback = %r\n  xhtml = %r",
+                  src, dest, path, link_callback, xhtml)
     # Build story
     context = pisa_story(src, path, link_callback, debug, default_css, xhtml, encoding,
                          context=PisaContext(path, debug=debug, capacity=capacity), xml_output=xml_output)
 
-    # Buffer PDF into memory
-    out = NamedTemporaryFile()
+    # Buffer PDF into memory, only documents above capacity spill to disk
+    out = SpooledTemporaryFile(max_size=capacity)
+    meta = context.meta
     doc = PmlBaseDoc(out,
                      pagesize=context.pageSize,
-                     author=context.meta["author"].strip(),
-                     subject=context.meta["subject"].strip(),
-                     keywords=[x.strip() for x in context.meta["keywords"].strip().split(",") if x],
-                     title=context.meta["title"].strip(),
+                     author=meta["author"].strip(),
+                     subject=meta["subject"].strip(),
+                     keywords=[x for x in (x.strip() for x in meta["keywords"].split(",")) if x],
+                     title=meta["title"].strip(),
                      showBoundary=0,
                      allowSplitting=1)
     # Prepare templates and their frames
@@ -107,46 +209,33 @@ def pisa_document(src, dest=None, path=None, link_callback=None, debug=0, defaul
                                              topPadding=0)],
                                pagesize=context.pageSize)
 
-    doc.addPageTemplates([body] + list(context.templateList.values()))
+    templates = [body]
+    templates.extend(context.templateList.values())
+    doc.addPageTemplates(templates)
     # Use multibuild e.g. if a TOC has to be created
     if context.multiBuild:
         doc.multiBuild(context.story)
     else:
         doc.build(context.story)
-    # Add watermarks
-    if PyPDF2:
-        for bgouter in context.pisaBackgroundList:
-            # If we have at least one background, then lets do it
-            if bgouter:
-                istream = out
-
-                output = PyPDF2.PdfFileWriter()
-                input1 = PyPDF2.PdfFileReader(istream)
-                ctr = 0
-                # TODO: Why do we loop over the same list again?
-                # see bgouter at line 137
-                for bg in context.pisaBackgroundList:
-                    page = input1.getPage(ctr)
-                    if bg and not bg.not_found() and bg.mimetype == "application/pdf":
-                        bginput = PyPDF2.PdfFileReader(bg.get_file())
-                        pagebg = bginput.getPage(0)
-                        pagebg.mergePage(page)
-                        page = pagebg
-                    else:
-                        log.warn(context.warning("Background PDF %s doesn't exist.", bg))
-                    output.addPage(page)
-                    ctr += 1
-                out = NamedTemporaryFile()
-                output.write(out)
-                # data = sout.getvalue()
-                # Found a background? So leave loop after first occurence
-                break
+    # Add watermarks, if we have at least one background
+    merge = any(context.pisaBackgroundList)
+    if merge and fitz is None and not PyPDF2:
+        log.warn(context.warning("PyPDF2 not installed, PDF backgrounds are skipped!"))
+        merge = False
+
+    # Write the resulting PDF straight to the file object passed from the
+    # caller, without buffering it in another temporary file
+    if merge:
+        if dest is None:
+            dest = SpooledTemporaryFile(max_size=capacity)
+            pisa_add_backgrounds(context, out, dest)
+            dest.seek(0)
+        else:
+            pisa_add_backgrounds(context, out, dest)
+    elif dest is None:
+        out.seek(0)
+        dest = out
     else:
-        log.warn(context.warning("PyPDF2 not installed!"))
-    # Get the resulting PDF and write it to the file object
-    # passed from the caller
-    context.dest = NamedTemporaryFile()
-    if dest is not None:
-        context.dest.write(dest.getvalue().encode())
-    context.dest.write(out.file.read())  # TODO: context.dest is a tempfile as well...
+        _copy_to_dest(out, dest, capacity)
+    context.dest = dest
     return context
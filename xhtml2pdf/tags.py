@@ -6,9 +6,9 @@ from reportlab.lib.units import inch, mm
 from reportlab.platypus.doctemplate import NextPageTemplate, FrameBreak
 from reportlab.platypus.flowables import Spacer, HRFlowable, PageBreak, Flowable
 from reportlab.platypus.frames import Frame
-from reportlab.platypus.paraparser import tt2ps, ABag
+from reportlab.platypus.paraparser import ABag
 from xhtml2pdf import xhtml2pdf_reportlab
-from xhtml2pdf.util import get_color, get_size, get_alignment, dpi96
+from xhtml2pdf.util import get_color, get_size, get_alignment, dpi96, get_ps_font_name
 from xhtml2pdf.xhtml2pdf_reportlab import PmlImage, PmlPageTemplate
 import copy
 import logging
@@ -120,7 +120,7 @@ class pisaTagA(pisaTag):
                 name=attr.name,
                 label="anchor")
             c.fragAnchor.append(afrag)
-            c.anchorName.append(attr.name)
+            c.anchorName.add(attr.name)
         if attr.href and self.rxLink.match(attr.href):
             c.frag.link = attr.href
 
@@ -309,7 +309,7 @@ class pisaTagLI(pisaTag):
                 frag.text = lst(c)
 
         # XXX This should usually be done in the context!!!
-        frag.fontName = frag.bulletFontName = tt2ps(frag.fontName, frag.bold, frag.italic)
+        frag.fontName = frag.bulletFontName = get_ps_font_name(frag.fontName, frag.bold, frag.italic)
         c.frag.bulletText = [frag]
 
     def end(self, c):
@@ -28,10 +28,12 @@ from functools import wraps
 from io import UnsupportedOperation
 
 from six import binary_type, StringIO
+from six.moves import intern
 
 from reportlab.lib.colors import Color, toColor
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
 from reportlab.lib.units import inch, cm
+from reportlab.platypus.paraparser import tt2ps
 
 try:
     import httplib
@@ -65,6 +67,14 @@ try:
 except:
     PyPDF2 = None
 
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+
 try:
     from reportlab.graphics import renderPM
 except:
@@ -90,6 +100,7 @@ def memoized(fn):
     @wraps(fn)
     def helper(*args, **kwargs):
         return memoize(*args, **kwargs)
+    helper.cache_clear = memoize.cache.clear
     return helper
 
 class Memoized(object):
@@ -140,6 +151,21 @@ def format_error_message():
     return "Traceback (innermost last):\n" + "%-20s %s" % ("".join(tb_list[: - 1]), tb_list[- 1])
 
 
+@memoized
+def get_ps_font_name(font_name, bold, italic):
+    """
+    Cached version of ReportLab's `tt2ps`. The result is interned so all
+    fragments using a font share the same name string.
+
+    `tt2ps` depends on the font mappings, clear the cache with
+    `get_ps_font_name.cache_clear()` after calling `addMapping`.
+    """
+    ps_font_name = tt2ps(font_name, bold, italic)
+    if isinstance(ps_font_name, str):
+        ps_font_name = intern(ps_font_name)
+    return ps_font_name
+
+
 def to_list(value):
     if type(value) not in (list, tuple):
         return [value]
@@ -30,31 +30,34 @@ Dependencies:
     re
 """
 
+import abc
 import re
-import six
-
-from xhtml2pdf.w3c.cssSpecial import cleanup_css
+from six import add_metaclass, text_type
 
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 can only intern byte strings and the parser works on text
+    def intern(string):
+        return string
 
-def is_at_rule_ident(src, ident):
-    """
-
-    :param src:
-    :param ident:
-    :return:
-    """
-    return re.match(r'^@' + ident + r'\s*', src)
+from xhtml2pdf.w3c.cssSpecial import cleanup_css
 
 
-def strip_at_rule_ident(src):
-    """
+def _group_matcher(rexpression):
+    """CSSParser._get_match_result with the default arguments, bound to
+    one regular expression"""
+    match = rexpression.match
 
-    :param src:
-    :return:
-    """
-    return re.sub(r'^@[a-z\-]+\s*', '', src)
+    def get_match_result(src, pos):
+        result = match(src, pos)
+        if result is None:
+            return None, pos
+        return result.group(1), result.end()
+    return get_match_result
 
 
+@add_metaclass(abc.ABCMeta)
 class CSSSelectorAbstract(object):
     """Outlines the interface between CSSParser and it's rule-builder for selectors.
 
@@ -63,25 +66,32 @@ class CSSSelectorAbstract(object):
 
     See css.CSSMutableSelector for an example implementation.
     """
+    @abc.abstractmethod
     def add_hash_id(self, hashId):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def add_class(self, class_):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def add_attribute(self, attrName):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def add_attribute_operation(self, attrName, op, attrValue):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def add_pseudo(self, name):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def add_pseudo_function(self, name, value):
         raise NotImplementedError('Subclass responsibility')
 
 
+@add_metaclass(abc.ABCMeta)
 class CSSBuilderAbstract(object):
     """
     Outlines the interface between CSSParser and it's rule-builder.  Compose
@@ -95,49 +105,63 @@ class CSSBuilderAbstract(object):
 
     # ~ css results ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    @abc.abstractmethod
     def begin_stylesheet(self):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def stylesheet(self, elements):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def end_stylesheet(self):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def begin_inline(self):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def inline(self, declarations):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def end_inline(self):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def ruleset(self, selectors, declarations):
         raise NotImplementedError('Subclass responsibility')
 
     # ~ css namespaces ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    @abc.abstractmethod
     def resolve_namespace_prefix(self, nsPrefix, name):
         raise NotImplementedError('Subclass responsibility')
 
     # ~ css @ directives ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    @abc.abstractmethod
     def at_charset(self, charset):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def at_import(self, import_, mediums, cssParser):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def at_namespace(self, nsPrefix, uri):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def at_media(self, mediums, ruleset):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def at_page(self, page, pseudopage, declarations):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def at_font_face(self, declarations):
         raise NotImplementedError('Subclass responsibility')
 
@@ -146,43 +170,55 @@ class CSSBuilderAbstract(object):
 
     # ~ css selectors ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    @abc.abstractmethod
     def combine_selectors(self, selectorA, combiner, selectorB):
         """Return value must implement CSSSelectorAbstract"""
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def selector(self, name):
         """Return value must implement CSSSelectorAbstract"""
         raise NotImplementedError('Subclass responsibility')
 
     # ~ css declarations ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    @abc.abstractmethod
     def property(self, name, value, important=False):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def combine_terms(self, termA, combiner, termB):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_ident(self, value):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_number(self, value, units=None):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_rgb(self, value):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_uri(self, value):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_string(self, value):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_unicode_range(self, value):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_function(self, name, value):
         raise NotImplementedError('Subclass responsibility')
 
+    @abc.abstractmethod
     def term_unknown(self, src):
         raise NotImplementedError('Subclass responsibility')
 
@@ -190,6 +226,15 @@ class CSSBuilderAbstract(object):
 # ~ CSS Parser
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+def _tail_index(src, part):
+    """Index of part in src or None, the parser mostly passes tails of the
+    same source and then the index follows from the lengths without searching"""
+    if src.endswith(part):
+        return len(src) - len(part)
+    idx = src.find(part)
+    return idx if idx >= 0 else None
+
+
 class CSSParseError(Exception):
     src = None
     ctxsrc = None
@@ -204,9 +249,7 @@ class CSSParseError(Exception):
         self.src = src
         self.ctxsrc = ctxsrc or src
         if self.ctxsrc:
-            self.srcCtxIdx = self.ctxsrc.find(self.src)
-            if self.srcCtxIdx < 0:
-                del self.srcCtxIdx
+            self.srcCtxIdx = _tail_index(self.ctxsrc, self.src)
 
     def __str__(self):
         if self.ctxsrc:
@@ -221,12 +264,19 @@ class CSSParseError(Exception):
         if inline:
             self.inline = inline
         if self.fullsrc:
-            self.srcFullIdx = self.fullsrc.find(self.src)
-            if self.srcFullIdx < 0:
-                del self.srcFullIdx
-            self.ctxsrcFullIdx = self.fullsrc.find(self.ctxsrc)
-            if self.ctxsrcFullIdx < 0:
-                del self.ctxsrcFullIdx
+            # Errors of imported style sheets get the source of every
+            # style sheet they pass, so reset what is not found
+            self.srcFullIdx = _tail_index(self.fullsrc, self.src)
+            self.ctxsrcFullIdx = _tail_index(self.fullsrc, self.ctxsrc)
+
+
+class _FunctionStart(object):
+    """Name and context of a function term whose arguments follow"""
+    __slots__ = ('name', 'ctxpos')
+
+    def __init__(self, name, ctxpos):
+        self.name = name
+        self.ctxpos = ctxpos
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -284,13 +334,45 @@ class CSSParser(object):
     # ~ Constants / Variables / Etc.
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    # Parsers are created for every document and style attribute
+    __slots__ = ('_css_builder', '_inline_cache')
+
     ParseError = CSSParseError
 
     attribute_operators = ['=', '~=', '|=', '&=', '^=', '!=', '<>']
     selector_qualifiers = ('#', '.', '[', ':')
-    selector_combiners = ['+', '>']
+    selector_qualifier_chars = frozenset(selector_qualifiers)
+    # Combiners and operators are single characters, the parser looks them
+    # up by the character at the current position
+    selector_combiners = ('+', '>')
     expression_operators = ('/', '+', ',')
 
+    # Characters that end a selector group, a selector, a declaration group
+    # and an expression, the latter includes the "!" of "!important"
+    selector_group_stops = frozenset('{}]();')
+    selector_stops = frozenset(',;{}[]()')
+    declaration_stops = frozenset(',{}[]()@')
+    expression_stops = frozenset(';{}[])!')
+
+    # Many elements of a document share the same style attributes, the
+    # results of parse_inline are kept by source. Every hit returns the same
+    # ruleset object, callers must not mutate it.
+    inline_cache_size = 2048
+
+    # First characters of url() and of strings
+    term_u_chars = frozenset('uU')
+    term_string_chars = frozenset('"\'')
+
+    # Lower cased at-rule name -> method, unknown at-rules go to _parse_at_ident
+    at_keyword_handlers = {
+        'media': '_parse_at_media',
+        'page': '_parse_at_page',
+        'font-face': '_parse_at_font_face',
+        # XXX added @import, was missing!
+        'import': '_parse_at_imports',
+        'frame': '_parse_at_frame',
+    }
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # ~ Regular expressions
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -309,20 +391,28 @@ class CSSParser(object):
     re_ident = re.compile(i_ident, _reflags)
     # Caution: treats all characters above 0x7f as legal for an identifier.
     i_unicodeid = r'([^\u0000-\u007f]+)'
-    re_unicodeid = re.compile(i_unicodeid, _reflags)
     i_element_name = '((?:%s)|\*)' % (i_ident[1:-1],)
-    re_element_name = re.compile(i_element_name, _reflags)
     i_namespace_selector = '((?:%s)|\*|)\|(?!=)' % (i_ident[1:-1],)
-    re_namespace_selector = re.compile(i_namespace_selector, _reflags)
+    # Optional namespace prefix followed by an optional element or
+    # attribute name, one match gives both
+    re_ns_element_name = re.compile('(?:%s)?%s?' % (i_namespace_selector, i_element_name), _reflags)
+    re_ns_attribute_name = re.compile('(?:%s)?%s?' % (i_namespace_selector, i_ident), _reflags)
     i_class = '\\.' + i_ident
-    re_class = re.compile(i_class, _reflags)
     i_hash = '#((?:%s)+)' % i_nmchar
-    re_hash = re.compile(i_hash, _reflags)
+    # Ids and classes of a simple selector, one match takes a whole run
+    # of them and findall splits it into (id, class) pairs
+    i_hash_class = _orRule('#((?:%s)+)' % i_nmchar, '\\.(%s)' % i_ident[1:-1])
+    re_hash_class = re.compile(i_hash_class, _reflags)
+    re_hash_class_run = re.compile('(?:%s)+' % i_hash_class, _reflags)
     i_rgbcolor = '(#%s{6}|#%s{3})' % (i_hex, i_hex)
-    re_rgbcolor = re.compile(i_rgbcolor, _reflags)
     i_nl = u'\n|\r\n|\r|\f'
     i_escape_nl = u'\\\\(?:%s)' % i_nl
-    i_string_content = _orRule(u'[\t !#$%&(-~]', i_escape_nl, i_nonascii, i_escape)
+    # Every alternative of the string content starts with a different
+    # character and escapes cannot be split into shorter ones, so a string
+    # that is not closed fails in linear instead of exponential time
+    i_string_unicode = u'\\\\(?:%s{6}|%s{1,5}(?!%s))(?:\\s|(?!\\s))' % (i_hex, i_hex, i_hex)
+    i_string_escape = _orRule(i_string_unicode, u'\\\\(?!%s)[\t -~\200-\377]' % i_hex, i_escape_nl)
+    i_string_content = _orRule(u'[\t !#$%&(-\\[\\]-~]', i_string_escape, i_nonascii)
     i_string1 = u'\"((?:%s|\')*)\"' % i_string_content
     i_string2 = u'\'((?:%s|\")*)\'' % i_string_content
     i_string = _orRule(i_string1, i_string2)
@@ -333,17 +423,23 @@ class CSSParser(object):
     # i_uri = u'(url\\(.*?\\))'
     re_uri = re.compile(i_uri, _reflags)
     i_num = u'(([-+]?[0-9]+(?:\\.[0-9]+)?)|([-+]?\\.[0-9]+))' # XXX Added out paranthesis, because e.g. .5em was not parsed correctly
-    re_num = re.compile(i_num, _reflags)
     i_unit = '(%%|%s)?' % i_ident
-    re_unit = re.compile(i_unit, _reflags)
     i_function = i_ident + '\\('
-    re_function = re.compile(i_function, _reflags)
     i_functionterm = u'[-+]?' + i_function
-    re_functionterm = re.compile(i_functionterm, _reflags)
-    i_unicoderange1 = "(?:U\\+%s{1,6}-%s{1,6})" % (i_hex, i_hex)
+    i_unicoderange1 = "(?:[Uu]\\+%s{1,6}-%s{1,6})" % (i_hex, i_hex)
     i_unicoderange2 = "(?:U\\+\?{1,6}|{h}(\?{0,5}|{h}(\?{0,4}|{h}(\?{0,3}|{h}(\?{0,2}|{h}(\??|{h}))))))"
     i_unicoderange = i_unicoderange1 # u'(%s|%s)' % (i_unicoderange1, i_unicoderange2)
-    re_unicoderange = re.compile(i_unicoderange, _reflags)
+    # The terms that are not strings or url() in the order they are tried,
+    # the outer named group of the alternative that matched is lastgroup
+    i_term = _orRule('(?P<number>(?P<num>%s)(?P<unit>%%|%s)?)' % (i_num[1:-1], i_ident[1:-1]),
+                     '[-+]?(?P<function>%s)\\(' % i_ident[1:-1],
+                     '(?P<rgb>%s)' % i_rgbcolor[1:-1],
+                     '(?P<unicoderange>%s)' % i_unicoderange,
+                     '(?P<ident>(?:(?P<ns>%s|\\*|)\\|(?!=))?(?P<name>%s))' % (i_ident[1:-1], i_ident[1:-1]),
+                     '(?P<unicodeid>%s)' % i_unicodeid[1:-1])
+    # Every letter in the term alternatives is written in both cases, without
+    # re.I the regex engine does not case fold each character it looks at
+    re_term = re.compile(i_term, _reflags & ~re.I)
 
     # i_comment = u'(?:\/\*[^*]*\*+([^/*][^*]*\*+)*\/)|(?://.*)'
     # gabriel: only C convention for comments is allowed in CSS
@@ -351,14 +447,34 @@ class CSSParser(object):
     re_comment = re.compile(i_comment, _reflags)
     i_important = u'!\s*(important)'
     re_important = re.compile(i_important, _reflags)
+    i_nmchars = '((?:%s)*)' % i_nmchar
+    re_nmchars = re.compile(i_nmchars, _reflags)
+    # Everything of a declaration before its value: "ident S* ':' S*", the
+    # ':' may also be a '=' or missing
+    i_declaration_colon = r'\s*(?:[:=]\s*)?'
+    re_declaration_colon = re.compile(i_declaration_colon, _reflags)
+    re_declaration_head = re.compile(i_ident + i_declaration_colon, _reflags)
+    re_ws = re.compile(r'\s*', _reflags)
+    re_s_cdo_cdc = re.compile(r'(?:\s+|<!--|-->)*', _reflags)
+    re_media_and_brace = re.compile(r'.*({.*)', _reflags)
+    re_selector_skip = re.compile(r'[^,;{}\[\]()]*', _reflags)
+    re_at_rule_end = re.compile(r'[;{]', _reflags)
+    # Longest first, so that a shorter operator never hides a longer one
+    re_attribute_operator = re.compile('|'.join(
+        re.escape(op) for op in sorted(attribute_operators, key=len, reverse=True)))
     del _orRule
 
+    # Matchers for the expressions that are looked up for every declaration
+    _match_nmchars = staticmethod(_group_matcher(re_nmchars))
+    _match_important = staticmethod(_group_matcher(re_important))
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # ~ Public
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def __init__(self, css_builder=None):
         self._css_builder = css_builder
+        self._inline_cache = {}
 
     # ~ CSS Builder to delegate to ~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -371,6 +487,7 @@ class CSSParser(object):
     def css_builder(self, value):
         """A concrete instance implementing CSSBuilderAbstract"""
         self._css_builder = value
+        self._inline_cache = {}
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # ~ Public CSS Parsing API
@@ -399,14 +516,17 @@ class CSSParser(object):
         """
 
         self.css_builder.begin_stylesheet()
-        if not isinstance(src, six.text_type):
+        if not isinstance(src, text_type):
             src = src.decode()  # FIXME use text from the get-go
-        assert isinstance(src, six.text_type), "'src' must be text!"
         try:
             # XXX Some simple preprocessing
             src = cleanup_css(src)
+            # Get rid of the comments, most style sheets have none
+            css = src
+            if '/*' in css:
+                css = self.re_comment.sub(u'', css)
             try:
-                src, stylesheet = self._parse_stylesheet(src)
+                pos, stylesheet = self._parse_stylesheet(css, 0)
             except self.ParseError as err:
                 err.setFullCSSSource(src)
                 raise
@@ -416,11 +536,19 @@ class CSSParser(object):
 
     def parse_inline(self, src):
         """Parses CSS inline source string using the current cssBuilder.
-        Use to parse a tag's 'style'-like attribute."""
+        Use to parse a tag's 'style'-like attribute.
+
+        Results are cached by source, the same ruleset is returned for equal
+        sources and must not be mutated."""
+        try:
+            return self._inline_cache[src]
+        except KeyError:
+            pass
+
         self.css_builder.begin_inline()
         try:
             try:
-                src, properties = self._parse_declaration_group(src.strip(), braces=False)
+                pos, properties = self._parse_declaration_group(src, self._skip_ws(src, 0), braces=False)
             except self.ParseError as err:
                 err.setFullCSSSource(src, inline=True)
                 raise
@@ -428,6 +556,7 @@ class CSSParser(object):
             result = self.css_builder.inline(properties)
         finally:
             self.css_builder.end_inline()
+        self._cache_inline(src, result)
         return result
 
     def parse_attributes(self, attributes=None, **kwAttributes):
@@ -443,11 +572,16 @@ class CSSParser(object):
 
         self.css_builder.begin_inline()
         try:
+            # Each value is parsed on its own, joining them into one
+            # declaration group would let a ';' or '}' in one value spill
+            # into the next
             properties = []
+            add_property = properties.append
+            parse_property = self._parse_declaration_property
             for propertyName, src in kwAttributes.items():
                 try:
-                    src, property = self._parse_declaration_property(src.strip(), propertyName)
-                    properties.append(property)
+                    pos, property = parse_property(src, self._skip_ws(src, 0), propertyName)
+                    add_property(property)
                 except self.ParseError as err:
                     err.setFullCSSSource(src, inline=True)
                     raise
@@ -462,104 +596,106 @@ class CSSParser(object):
 
         See also: parseAttributes
         """
-
         results = self.parse_attributes(temp=attrValue)
         if 'temp' in results[1]:
             return results[1]['temp']
         else:
             return results[0]['temp']
 
+    def _cache_inline(self, key, result):
+        cache = self._inline_cache
+        if len(cache) >= self.inline_cache_size:
+            cache.clear()
+        cache[key] = result
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # ~ Internal _parse methods
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _parse_stylesheet(self, src):
+    def _parse_stylesheet(self, src, pos):
         """stylesheet
         : [ CHARSET_SYM S* STRING S* ';' ]?
             [S|CDO|CDC]* [ import [S|CDO|CDC]* ]*
             [ [ ruleset | media | page | font_face ] [S|CDO|CDC]* ]*
         ;
         """
-        # Get rid of the comments
-        src = self.re_comment.sub(six.u(''), src)
-
         # [ CHARSET_SYM S* STRING S* ';' ]?
-        src = self._parse_at_charset(src)
+        pos = self._parse_at_charset(src, pos)
 
         # [S|CDO|CDC]*
-        src = self._parse_s_cdo_cdc(src)
+        pos = self._parse_s_cdo_cdc(src, pos)
         #  [ import [S|CDO|CDC]* ]*
-        src, stylesheet_imports = self._parse_at_imports(src)
+        pos, stylesheet_imports = self._parse_at_imports(src, pos)
 
         # [ namespace [S|CDO|CDC]* ]*
-        src = self._parse_at_namespace(src)
+        pos = self._parse_at_namespace(src, pos)
 
         stylesheet_elements = []
+        add_element = stylesheet_elements.append
+        add_elements = stylesheet_elements.extend
+        parse_at_keyword = self._parse_at_keyword
+        parse_ruleset = self._parse_ruleset
+        parse_s_cdo_cdc = self._parse_s_cdo_cdc
 
         # [ [ ruleset | atkeywords ] [S|CDO|CDC]* ]*
-        while src:  # due to ending with ]*
-            if src.startswith('@'):
+        end = len(src)
+        while pos < end:  # due to ending with ]*
+            if src[pos] == '@':
                 # @media, @page, @font-face
-                src, at_results = self._parse_at_keyword(src)
+                pos, at_results = parse_at_keyword(src, pos)
                 if at_results is not None and at_results != NotImplemented:
-                    stylesheet_elements.extend(at_results)
+                    add_elements(at_results)
             else:
                 # ruleset
-                src, ruleset = self._parse_ruleset(src)
-                stylesheet_elements.append(ruleset)
+                pos, ruleset = parse_ruleset(src, pos)
+                add_element(ruleset)
 
             # [S|CDO|CDC]*
-            src = self._parse_s_cdo_cdc(src)
+            pos = parse_s_cdo_cdc(src, pos)
 
         stylesheet = self.css_builder.stylesheet(stylesheet_elements, stylesheet_imports)
-        return src, stylesheet
+        return pos, stylesheet
 
-    def _parse_s_cdo_cdc(self, src):
+    def _parse_s_cdo_cdc(self, src, pos):
         """[S|CDO|CDC]*"""
-        while True:
-            src = src.lstrip()
-            if src.startswith('<!--'):
-                src = src[4:]
-            elif src.startswith('-->'):
-                src = src[3:]
-            else:
-                break
-        return src
+        return self.re_s_cdo_cdc.match(src, pos).end()
 
     # ~ CSS @ directives ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _parse_at_charset(self, src):
+    def _parse_at_charset(self, src, pos):
         """[ CHARSET_SYM S* STRING S* ';' ]?"""
-        if is_at_rule_ident(src, 'charset'):
-            ctxsrc = src
-            src = strip_at_rule_ident(src)
-            charset, src = self._get_string(src)
-            src = src.lstrip()
-            if src[:1] != ';':
-                raise self.ParseError('@charset expected a terminating \';\'', src, ctxsrc)
-            src = src[1:].lstrip()
+        end = self._at_rule_end(src, pos, 'charset')
+        if end is not None:
+            ctxpos, pos = pos, end
+            charset, pos = self._get_string(src, pos)
+            pos = self._skip_ws(src, pos)
+            if not src.startswith(';', pos):
+                raise self.ParseError('@charset expected a terminating \';\'', src[pos:], src[ctxpos:])
+            pos = self._skip_ws(src, pos + 1)
 
             self.css_builder.at_charset(charset)
-        return src
+        return pos
 
-    def _parse_at_imports(self, src):
+    def _parse_at_imports(self, src, pos):
         """[ import [S|CDO|CDC]* ]*"""
         result = []
-        while is_at_rule_ident(src, 'import'):
-            ctxsrc = src
-            src = strip_at_rule_ident(src)
+        while True:
+            end = self._at_rule_end(src, pos, 'import')
+            if end is None:
+                break
+            ctxpos, pos = pos, end
 
-            import_, src = self._get_string_or_uri(src)
+            import_, pos = self._get_string_or_uri(src, pos)
             if import_ is None:
-                raise self.ParseError('Import expecting string or url', src, ctxsrc)
+                raise self.ParseError('Import expecting string or url', src[pos:], src[ctxpos:])
 
             mediums = []
-            medium, src = self._get_ident(src.lstrip())
+            medium, pos = self._get_ident(src, self._skip_ws(src, pos))
             while medium is not None:
                 mediums.append(medium)
-                if src[:1] == ',':
-                    src = src[1:].lstrip()
-                    medium, src = self._get_ident(src)
+                if src.startswith(',', pos):
+                    pos = self._skip_ws(src, pos + 1)
+                    medium, pos = self._get_ident(src, pos)
                 else:
                     break
 
@@ -567,578 +703,661 @@ class CSSParser(object):
             if not mediums:
                 mediums = ["all"]
 
-            if src[:1] != ';':
-                raise self.ParseError('@import expected a terminating \';\'', src, ctxsrc)
-            src = src[1:].lstrip()
+            if not src.startswith(';', pos):
+                raise self.ParseError('@import expected a terminating \';\'', src[pos:], src[ctxpos:])
+            pos = self._skip_ws(src, pos + 1)
 
             stylesheet = self.css_builder.at_import(import_, mediums, self)
             if stylesheet is not None:
                 result.append(stylesheet)
 
-            src = self._parse_s_cdo_cdc(src)
-        return src, result
+            pos = self._parse_s_cdo_cdc(src, pos)
+        return pos, result
 
-    def _parse_at_namespace(self, src):
+    def _parse_at_namespace(self, src, pos):
         """namespace :
 
         @namespace S* [IDENT S*]? [STRING|URI] S* ';' S*
         """
 
-        src = self._parse_s_cdo_cdc(src)
-        while is_at_rule_ident(src, 'namespace'):
-            ctxsrc = src
-            src = strip_at_rule_ident(src)
+        pos = self._parse_s_cdo_cdc(src, pos)
+        while True:
+            end = self._at_rule_end(src, pos, 'namespace')
+            if end is None:
+                break
+            ctxpos, pos = pos, end
 
-            namespace, src = self._get_string_or_uri(src)
+            namespace, pos = self._get_string_or_uri(src, pos)
             if namespace is None:
-                nsPrefix, src = self._get_ident(src)
+                nsPrefix, pos = self._get_ident(src, pos)
                 if nsPrefix is None:
-                    raise self.ParseError('@namespace expected an identifier or a URI', src, ctxsrc)
-                namespace, src = self._get_string_or_uri(src.lstrip())
+                    raise self.ParseError('@namespace expected an identifier or a URI', src[pos:], src[ctxpos:])
+                namespace, pos = self._get_string_or_uri(src, self._skip_ws(src, pos))
                 if namespace is None:
-                    raise self.ParseError('@namespace expected a URI', src, ctxsrc)
+                    raise self.ParseError('@namespace expected a URI', src[pos:], src[ctxpos:])
             else:
                 nsPrefix = None
 
-            src = src.lstrip()
-            if src[:1] != ';':
-                raise self.ParseError('@namespace expected a terminating \';\'', src, ctxsrc)
-            src = src[1:].lstrip()
+            pos = self._skip_ws(src, pos)
+            if not src.startswith(';', pos):
+                raise self.ParseError('@namespace expected a terminating \';\'', src[pos:], src[ctxpos:])
+            pos = self._skip_ws(src, pos + 1)
 
             self.css_builder.at_namespace(nsPrefix, namespace)
 
-            src = self._parse_s_cdo_cdc(src)
-        return src
+            pos = self._parse_s_cdo_cdc(src, pos)
+        return pos
 
-    def _parse_at_keyword(self, src):
+    def _parse_at_keyword(self, src, pos):
         """[media | page | font_face | unknown_keyword]"""
-        ctxsrc = src
-        if is_at_rule_ident(src, 'media'):
-            src, result = self._parse_at_media(src)
-        elif is_at_rule_ident(src, 'page'):
-            src, result = self._parse_at_page(src)
-        elif is_at_rule_ident(src, 'font-face'):
-            src, result = self._parse_at_font_face(src)
-        # XXX added @import, was missing!
-        elif is_at_rule_ident(src, 'import'):
-            src, result = self._parse_at_imports(src)
-        elif is_at_rule_ident(src, 'frame'):
-            src, result = self._parse_at_frame(src)
-        elif src.startswith('@'):
-            src, result = self._parse_at_ident(src)
+        keyword = self._get_at_keyword(src, pos)[0]
+        handler = self.at_keyword_handlers.get(keyword)
+        if handler is not None:
+            return getattr(self, handler)(src, pos)
+        elif src.startswith('@', pos):
+            return self._parse_at_ident(src, pos)
         else:
-            raise self.ParseError('Unknown state in atKeyword', src, ctxsrc)
-        return src, result
+            raise self.ParseError('Unknown state in atKeyword', src[pos:])
 
-    def _parse_at_media(self, src):
+    def _parse_at_media(self, src, pos):
         """media
         : MEDIA_SYM S* medium [ ',' S* medium ]* '{' S* ruleset* '}' S*
         ;
         """
-        ctxsrc = src
-        src = src[len('@media '):].lstrip()
+        ctxpos = pos
+        end = len(src)
+        pos = self._skip_ws(src, pos + len('@media'))
         mediums = []
-        while src and src[0] != '{':
-            medium, src = self._get_ident(src)
+        while pos < end and src[pos] != '{':
+            medium, pos = self._get_ident(src, pos)
             if medium is None:
-                raise self.ParseError('@media rule expected media identifier', src, ctxsrc)
+                raise self.ParseError('@media rule expected media identifier', src[pos:], src[ctxpos:])
             # make "and ... {" work
             if medium == u'and':
                 # strip up to curly bracket
-                pattern = re.compile('.*({.*)')
-                match = re.match(pattern, src)
-                src = src[match.end()-1:]
+                match = self.re_media_and_brace.match(src, pos)
+                pos = match.end() - 1
                 break
             mediums.append(medium)
-            if src[0] == ',':
-                src = src[1:].lstrip()
+            if src[pos] == ',':
+                pos = self._skip_ws(src, pos + 1)
             else:
-                src = src.lstrip()
+                pos = self._skip_ws(src, pos)
 
-        if not src.startswith('{'):
-            raise self.ParseError('Ruleset opening \'{\' not found', src, ctxsrc)
-        src = src[1:].lstrip()
+        if not src.startswith('{', pos):
+            raise self.ParseError('Ruleset opening \'{\' not found', src[pos:], src[ctxpos:])
+        pos, stylesheet_elements = self._parse_ruleset_block(src, pos, ctxpos)
 
-        stylesheet_elements = []
-        # while src and not src.startswith('}'):
-        #    src, ruleset = self._parseRuleset(src)
-        #    stylesheetElements.append(ruleset)
-        #    src = src.lstrip()
+        result = self.css_builder.at_media(mediums, stylesheet_elements)
+        return pos, result
+
+    def _parse_ruleset_block(self, src, pos, ctxpos):
+        """'{' S* [ ruleset | atkeywords ]* '}' S*"""
+        end = len(src)
+        skip_ws = self._skip_ws
+        pos = skip_ws(src, pos + 1)
 
         # Containing @ where not found and parsed
-        while src and not src.startswith('}'):
-            if src.startswith('@'):
+        stylesheet_elements = []
+        add_element = stylesheet_elements.append
+        while pos < end:
+            ch = src[pos]
+            if ch == '}':
+                break
+            if ch == '@':
                 # @media, @page, @font-face
-                src, atResults = self._parse_at_keyword(src)
+                pos, atResults = self._parse_at_keyword(src, pos)
                 if atResults is not None:
                     stylesheet_elements.extend(atResults)
             else:
                 # ruleset
-                src, ruleset = self._parse_ruleset(src)
-                stylesheet_elements.append(ruleset)
-            src = src.lstrip()
+                pos, ruleset = self._parse_ruleset(src, pos)
+                add_element(ruleset)
+            pos = skip_ws(src, pos)
 
-        if not src.startswith('}'):
-            raise self.ParseError('Ruleset closing \'}\' not found', src, ctxsrc)
-        else:
-            src = src[1:].lstrip()
-
-        result = self.css_builder.at_media(mediums, stylesheet_elements)
-        return src, result
+        if not src.startswith('}', pos):
+            raise self.ParseError('Ruleset closing \'}\' not found', src[pos:], src[ctxpos:])
+        return skip_ws(src, pos + 1), stylesheet_elements
 
-    def _parse_at_page(self, src):
+    def _parse_at_page(self, src, pos):
         """page
         : PAGE_SYM S* IDENT? pseudo_page? S*
             '{' S* declaration [ ';' S* declaration ]* '}' S*
         ;
         """
-        ctxsrc = src
-        src = src[len('@page '):].lstrip()
-        page, src = self._get_ident(src)
-        if src[:1] == ':':
-            pseudopage, src = self._get_ident(src[1:])
+        ctxpos = pos
+        end = len(src)
+        pos = self._skip_ws(src, pos + len('@page'))
+        page, pos = self._get_ident(src, pos)
+        if src.startswith(':', pos):
+            pseudopage, pos = self._get_ident(src, pos + 1)
             page = page + '_' + pseudopage
         else:
             pseudopage = None
 
-        # src, properties = self._parseDeclarationGroup(src.lstrip())
-
         # Containing @ where not found and parsed
         stylesheet_elements = []
-        src = src.lstrip()
+        pos = self._skip_ws(src, pos)
         properties = []
 
         # XXX Extended for PDF use
-        if not src.startswith('{'):
-            raise self.ParseError('Ruleset opening \'{\' not found', src, ctxsrc)
+        if not src.startswith('{', pos):
+            raise self.ParseError('Ruleset opening \'{\' not found', src[pos:], src[ctxpos:])
         else:
-            src = src[1:].lstrip()
+            pos = self._skip_ws(src, pos + 1)
 
-        while src and not src.startswith('}'):
-            if src.startswith('@'):
+        while pos < end:
+            ch = src[pos]
+            if ch == '}':
+                break
+            if ch == '@':
                 # @media, @page, @font-face
-                src, at_results = self._parse_at_keyword(src)
+                pos, at_results = self._parse_at_keyword(src, pos)
                 if at_results is not None:
                     stylesheet_elements.extend(at_results)
             else:
-                src, nproperties = self._parse_declaration_group(src.lstrip(), braces=False)
-                properties += nproperties
-            src = src.lstrip()
+                pos, nproperties = self._parse_declaration_group(src, self._skip_ws(src, pos), braces=False)
+                properties.extend(nproperties)
+            pos = self._skip_ws(src, pos)
 
         result = [self.css_builder.at_page(page, pseudopage, properties)]
 
-        return src[1:].lstrip(), result
+        return self._skip_ws(src, min(pos + 1, end)), result
 
-    def _parse_at_frame(self, src):
+    def _parse_at_frame(self, src, pos):
         """
         XXX Proprietary for PDF
         """
-        ctxsrc = src
-        src = src[len('@frame '):].lstrip()
-        box, src = self._get_ident(src)
-        src, properties = self._parse_declaration_group(src.lstrip())
+        pos = self._skip_ws(src, pos + len('@frame'))
+        box, pos = self._get_ident(src, pos)
+        pos, properties = self._parse_declaration_group(src, self._skip_ws(src, pos))
         result = [self.css_builder.at_frame(box, properties)]
-        return src.lstrip(), result
+        return self._skip_ws(src, pos), result
 
-    def _parse_at_font_face(self, src):
-        ctxsrc = src
-        src = src[len('@font-face '):].lstrip()
-        src, properties = self._parse_declaration_group(src)
+    def _parse_at_font_face(self, src, pos):
+        pos = self._skip_ws(src, pos + len('@font-face'))
+        pos, properties = self._parse_declaration_group(src, pos)
         result = [self.css_builder.at_font_face(properties)]
-        return src, result
+        return pos, result
 
-    def _parse_at_ident(self, src):
-        ctxsrc = src
-        atIdent, src = self._get_ident(src[1:])
+    def _parse_at_ident(self, src, pos):
+        ctxpos = pos
+        atIdent, pos = self._get_ident(src, pos + 1)
         if atIdent is None:
-            raise self.ParseError('At-rule expected an identifier for the rule', src, ctxsrc)
+            raise self.ParseError('At-rule expected an identifier for the rule', src[pos:], src[ctxpos:])
 
-        src, result = self.css_builder.at_ident(atIdent, self, src)
+        # The builder gets and returns the remaining source, what it returns
+        # has to be a tail of what it got
+        rest, result = self.css_builder.at_ident(atIdent, self, src[pos:])
+        pos = len(src) - len(rest)
 
         if result is NotImplemented:
             # An at-rule consists of everything up to and including the next semicolon (;) or the next block,
             # whichever comes first
 
-            semiIdx = src.find(';')
-            if semiIdx < 0:
-                semiIdx = None
-            blockIdx = src[:semiIdx].find('{')
-            if blockIdx < 0:
-                blockIdx = None
-
-            if semiIdx is not None and semiIdx < blockIdx:
-                src = src[semiIdx + 1:].lstrip()
-            elif blockIdx is None:
+            rule_end = self.re_at_rule_end.search(src, pos)
+            if rule_end is None:
                 # consume the rest of the content since we didn't find a block or a semicolon
-                src = src[-1:-1]
-            elif blockIdx is not None:
+                pos = len(src)
+            elif rule_end.group() == ';':
+                pos = rule_end.end()
+            else:
                 # expecing a block...
-                src = src[blockIdx:]
+                pos = rule_end.start()
                 try:
                     # try to parse it as a declarations block
-                    src, declarations = self._parse_declaration_group(src)
+                    block_end, declarations = self._parse_declaration_block(src, pos)
                 except self.ParseError:
-                    # try to parse it as a stylesheet block
-                    src, stylesheet = self._parse_stylesheet(src)
-            else:
-                raise self.ParseError('Unable to ignore @-rule block', src, ctxsrc)
+                    declarations = None
+                if declarations is None:
+                    # try to parse it as a block of rulesets
+                    pos, stylesheet_elements = self._parse_ruleset_block(src, pos, ctxpos)
+                else:
+                    pos = block_end
 
-        return src.lstrip(), result
+        return self._skip_ws(src, pos), result
 
     # ~ ruleset - see selector and declaration groups ~~~~
 
-    def _parse_ruleset(self, src):
+    def _parse_ruleset(self, src, pos):
         """ruleset
         : selector [ ',' S* selector ]*
             '{' S* declaration [ ';' S* declaration ]* '}' S*
         ;
         """
-        src, selectors = self._parse_selector_group(src)
-        src, properties = self._parse_declaration_group(src.lstrip())
+        pos, selectors = self._parse_selector_group(src, pos)
+        pos, properties = self._parse_declaration_group(src, self._skip_ws(src, pos))
         result = self.css_builder.ruleset(selectors, properties)
-        return src, result
+        return pos, result
 
     # ~ selector parsing ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _parse_selector_group(self, src):
+    def _parse_selector_group(self, src, pos):
         selectors = []
-        while src[:1] not in ('{', '}', ']', '(', ')', ';', ''):
-            src, selector = self._parse_selector(src)
+        add_selector = selectors.append
+        parse_selector = self._parse_selector
+        stops = self.selector_group_stops
+        end = len(src)
+        while pos < end and src[pos] not in stops:
+            pos, selector = parse_selector(src, pos)
             if selector is None:
                 break
-            selectors.append(selector)
-            if src.startswith(','):
-                src = src[1:].lstrip()
-        return src, selectors
+            add_selector(selector)
+            if src.startswith(',', pos):
+                pos = self._skip_ws(src, pos + 1)
+        return pos, selectors
 
-    def _parse_selector(self, src):
+    def _parse_selector(self, src, pos):
         """selector
         : simple_selector [ combinator simple_selector ]*
         ;
         """
-        src, selector = self._parse_simple_selector(src)
-        srcLen = len(src) # XXX
-        while src[:1] not in ('', ',', ';', '{', '}', '[', ']', '(', ')'):
-            for combiner in self.selector_combiners:
-                if src.startswith(combiner):
-                    src = src[len(combiner):].lstrip()
-                    break
+        combine_selectors = self.css_builder.combine_selectors
+        parse_simple_selector = self._parse_simple_selector
+        skip_ws = self._skip_ws
+        stops = self.selector_stops
+        combiners = self.selector_combiners
+        end = len(src)
+        pos, selector = parse_simple_selector(src, pos)
+        start = pos  # XXX
+        while pos < end:
+            combiner = src[pos]
+            if combiner in stops:
+                break
+            if combiner in combiners:
+                pos = skip_ws(src, pos + 1)
             else:
                 combiner = ' '
-            src, selectorB = self._parse_simple_selector(src)
+            pos, selectorB = parse_simple_selector(src, pos)
 
             # XXX Fix a bug that occured here e.g. : .1 {...}
-            if len(src) >= srcLen:
-                src = src[1:]
-                while src and (src[:1] not in ('', ',', ';', '{', '}', '[', ']', '(', ')')):
-                    src = src[1:]
-                return src.lstrip(), None
+            if pos <= start:
+                pos = self.re_selector_skip.match(src, min(pos + 1, end)).end()
+                return skip_ws(src, pos), None
 
-            selector = self.css_builder.combine_selectors(selector, combiner, selectorB)
+            selector = combine_selectors(selector, combiner, selectorB)
 
-        return src.lstrip(), selector
+        return skip_ws(src, pos), selector
 
-    def _parse_simple_selector(self, src):
+    def _parse_simple_selector(self, src, pos):
         """simple_selector
         : [ namespace_selector ]? element_name? [ HASH | class | attrib | pseudo ]* S*
         ;
         """
-        ctxsrc = src.lstrip()
-        nsPrefix, src = self._get_match_result(self.re_namespace_selector, src)
-        name, src = self._get_match_result(self.re_element_name, src)
+        builder = self.css_builder
+        skip_ws = self._skip_ws
+        match_hash_class_run = self.re_hash_class_run.match
+        find_hash_class = self.re_hash_class.findall
+
+        ctxpos = skip_ws(src, pos)
+        match = self.re_ns_element_name.match(src, pos)
+        nsPrefix, name = match.groups()
+        pos = match.end()
         if name:
-            pass # already *successfully* assigned
-        elif src[:1] in self.selector_qualifiers:
+            # Element names, classes and ids repeat like identifiers do
+            name = intern(name)
+        elif src[pos:pos + 1] in self.selector_qualifier_chars:
             name = '*'
         else:
-            raise self.ParseError('Selector name or qualifier expected', src, ctxsrc)
-
-        name = self.css_builder.resolve_namespace_prefix(nsPrefix, name)
-        selector = self.css_builder.selector(name)
-        while src and src[:1] in self.selector_qualifiers:
-            hash_, src = self._get_match_result(self.re_hash, src)
-            if hash_ is not None:
-                selector.add_hash_id(hash_)
-                continue
+            raise self.ParseError('Selector name or qualifier expected', src[pos:], src[ctxpos:])
 
-            class_, src = self._get_match_result(self.re_class, src)
-            if class_ is not None:
-                selector.add_class(class_)
-                continue
-
-            if src.startswith('['):
-                src, selector = self._parse_selector_attribute(src, selector)
-            elif src.startswith(':'):
-                src, selector = self._parse_selector_pseudo(src, selector)
+        name = builder.resolve_namespace_prefix(nsPrefix, name)
+        selector = builder.selector(name)
+        while True:
+            run = match_hash_class_run(src, pos)
+            if run is not None:
+                run_end = run.end()
+                for hash_id, class_ in find_hash_class(src, pos, run_end):
+                    if hash_id:
+                        selector.add_hash_id(intern(hash_id))
+                    else:
+                        selector.add_class(intern(class_))
+                pos = run_end
+
+            ch = src[pos:pos + 1]
+            if ch == '[':
+                pos, selector = self._parse_selector_attribute(src, pos, selector)
+            elif ch == ':':
+                pos, selector = self._parse_selector_pseudo(src, pos, selector)
             else:
                 break
 
-        return src.lstrip(), selector
+        return skip_ws(src, pos), selector
 
-    def _parse_selector_attribute(self, src, selector):
+    def _parse_selector_attribute(self, src, pos, selector):
         """attrib
         : '[' S* [ namespace_selector ]? IDENT S* [ [ '=' | INCLUDES | DASHMATCH ] S*
             [ IDENT | STRING ] S* ]? ']'
         ;
         """
-        ctxsrc = src
-        if not src.startswith('['):
-            raise self.ParseError('Selector Attribute opening \'[\' not found', src, ctxsrc)
-        src = src[1:].lstrip()
+        ctxpos = pos
+        if not src.startswith('[', pos):
+            raise self.ParseError('Selector Attribute opening \'[\' not found', src[pos:], src[ctxpos:])
+        pos = self._skip_ws(src, pos + 1)
 
-        nsPrefix, src = self._get_match_result(self.re_namespace_selector, src)
-        attrName, src = self._get_ident(src)
+        match = self.re_ns_attribute_name.match(src, pos)
+        nsPrefix, attrName = match.groups()
+        pos = match.end()
 
-        src = src.lstrip()
+        pos = self._skip_ws(src, pos)
 
         if attrName is None:
-            raise self.ParseError('Expected a selector attribute name', src, ctxsrc)
+            raise self.ParseError('Expected a selector attribute name', src[pos:], src[ctxpos:])
+        attrName = intern(attrName)
         if nsPrefix is not None:
             attrName = self.css_builder.resolve_namespace_prefix(nsPrefix, attrName)
 
-        for op in self.attribute_operators:
-            if src.startswith(op):
-                break
-        else:
-            op = ''
-        src = src[len(op):].lstrip()
+        op, pos = self._get_match_result(self.re_attribute_operator, src, pos, '', 0)
+        pos = self._skip_ws(src, pos)
 
         if op:
-            attrValue, src = self._get_ident(src)
+            attrValue, pos = self._get_ident(src, pos)
             if attrValue is None:
-                attrValue, src = self._get_string(src)
+                attrValue, pos = self._get_string(src, pos)
                 if attrValue is None:
-                    raise self.ParseError('Expected a selector attribute value', src, ctxsrc)
+                    raise self.ParseError('Expected a selector attribute value', src[pos:], src[ctxpos:])
         else:
             attrValue = None
 
-        if not src.startswith(']'):
-            raise self.ParseError('Selector Attribute closing \']\' not found', src, ctxsrc)
+        if not src.startswith(']', pos):
+            raise self.ParseError('Selector Attribute closing \']\' not found', src[pos:], src[ctxpos:])
         else:
-            src = src[1:]
+            pos += 1
 
         if op:
             selector.add_attribute_operation(attrName, op, attrValue)
         else:
             selector.add_attribute(attrName)
-        return src, selector
+        return pos, selector
 
-    def _parse_selector_pseudo(self, src, selector):
+    def _parse_selector_pseudo(self, src, pos, selector):
         """pseudo
         : ':' [ IDENT | function ]
         ;
         """
-        ctxsrc = src
-        if not src.startswith(':'):
-            raise self.ParseError('Selector Pseudo \':\' not found', src, ctxsrc)
-        src = re.search('^:{1,2}(.*)', src, re.M | re.S).group(1)
+        ctxpos = pos
+        if not src.startswith(':', pos):
+            raise self.ParseError('Selector Pseudo \':\' not found', src[pos:], src[ctxpos:])
+        # ':' for pseudo classes, '::' for pseudo elements
+        pos += 2 if src.startswith('::', pos) else 1
 
-        name, src = self._get_ident(src)
+        name, pos = self._get_ident(src, pos)
         if not name:
-            raise self.ParseError('Selector Pseudo identifier not found', src, ctxsrc)
+            raise self.ParseError('Selector Pseudo identifier not found', src[pos:], src[ctxpos:])
 
-        if src.startswith('('):
+        if src.startswith('(', pos):
             # function
-            src = src[1:].lstrip()
-            src, term = self._parse_expression(src, True)
-            if not src.startswith(')'):
-                raise self.ParseError('Selector Pseudo Function closing \')\' not found', src, ctxsrc)
-            src = src[1:]
+            pos = self._skip_ws(src, pos + 1)
+            pos, term = self._parse_expression(src, pos, True)
+            if not src.startswith(')', pos):
+                raise self.ParseError('Selector Pseudo Function closing \')\' not found', src[pos:], src[ctxpos:])
+            pos += 1
             selector.add_pseudo_function(name, term)
         else:
             selector.add_pseudo(name)
 
-        return src, selector
+        return pos, selector
 
     # ~ declaration and expression parsing ~~~~~~~~~~~~~~~
 
-    def _parse_declaration_group(self, src, braces=True):
-        ctxsrc = src
-        if src.startswith('{'):
-            src, braces = src[1:], True
+    def _parse_declaration_group(self, src, pos, braces=True):
+        ctxpos = pos
+        pos, properties = self._parse_declaration_block(src, pos, braces)
+        if properties is None:
+            if not src.startswith('{', ctxpos):
+                raise self.ParseError('Declaration group opening \'{\' not found', src[pos:], src[ctxpos:])
+            raise self.ParseError('Declaration group closing \'}\' not found', src[pos:], src[ctxpos:])
+        return pos, properties
+
+    def _parse_declaration_block(self, src, pos, braces=True):
+        """Like _parse_declaration_group, but a missing brace returns None
+        for the properties instead of raising, for callers that go on
+        with something else then"""
+        if src.startswith('{', pos):
+            pos, braces = pos + 1, True
         elif braces:
-            raise self.ParseError('Declaration group opening \'{\' not found', src, ctxsrc)
+            return pos, None
 
         properties = []
-        src = src.lstrip()
-        while src[:1] not in ('', ',', '{', '}', '[', ']', '(', ')', '@'): # XXX @?
-            src, property = self._parse_declaration(src)
-
-            # XXX Workaround for styles like "*font: smaller"
-            if src.startswith("*"):
-                src = "-nothing-" + src[1:]
+        add_property = properties.append
+        parse_declaration = self._parse_declaration
+        skip_ws = self._skip_ws
+        pos = skip_ws(src, pos)
+        property_name = None
+        stops = self.declaration_stops
+        end = len(src)
+        while property_name is not None or (pos < end and src[pos] not in stops): # XXX @?
+            pos, property = parse_declaration(src, pos, property_name)
+            property_name = None
+
+            # XXX Workaround for styles like "*font: smaller", the property
+            # is read as if the "*" was replaced by "-nothing-"
+            if src.startswith("*", pos):
+                property_name, pos = self._match_nmchars(src, pos + 1)
+                property_name = "-nothing-" + property_name
                 continue
 
             if property is None:
                 break
-            properties.append(property)
-            if src.startswith(';'):
-                src = src[1:].lstrip()
+            add_property(property)
+            if src.startswith(';', pos):
+                pos = skip_ws(src, pos + 1)
             else:
                 break
 
         if braces:
-            if not src.startswith('}'):
-                raise self.ParseError('Declaration group closing \'}\' not found', src, ctxsrc)
-            src = src[1:]
+            if not src.startswith('}', pos):
+                return pos, None
+            pos += 1
 
-        return src.lstrip(), properties
+        return skip_ws(src, pos), properties
 
-    def _parse_declaration(self, src):
+    def _parse_declaration(self, src, pos, property_name=None):
         """declaration
         : ident S* ':' S* expr prio?
         | /* empty */
         ;
         """
-        # property
-        property_name, src = self._get_ident(src)
-
-        if property_name is not None:
-            src = src.lstrip()
-            # S* : S*
-            if src[:1] in (':', '='):
-                # Note: we are being fairly flexable here...  technically, the
-                # ":" is *required*, but in the name of flexibility we
-                # suppor a null transition, as well as an "=" transition
-                src = src[1:].lstrip()
-
-            src, property = self._parse_declaration_property(src, property_name)
+        # Note: we are being fairly flexable here...  technically, the ":" is
+        # *required*, but in the name of flexibility we suppor a null
+        # transition, as well as an "=" transition
+        if property_name is None:
+            # property S* : S*
+            match = self.re_declaration_head.match(src, pos)
+            if match is None:
+                return pos, None
+            property_name = intern(match.group(1))
         else:
-            property = None
+            # S* : S*
+            match = self.re_declaration_colon.match(src, pos)
 
-        return src, property
+        return self._parse_declaration_property(src, match.end(), property_name)
 
-    def _parse_declaration_property(self, src, propertyName):
+    def _parse_declaration_property(self, src, pos, propertyName):
         # expr
-        src, expr = self._parse_expression(src)
+        pos, expr = self._parse_expression(src, pos)
 
         # prio?
-        important, src = self._get_match_result(self.re_important, src)
-        src = src.lstrip()
+        important, pos = self._match_important(src, pos)
+        pos = self._skip_ws(src, pos)
 
         property = self.css_builder.property(propertyName, expr, important)
-        return src, property
+        return pos, property
 
-    def _parse_expression(self, src, returnList=False):
+    def _parse_expression(self, src, pos, returnList=False):
         """
         expr
         : term [ operator term ]*
         ;
         """
-        src, term = self._parse_expression_term(src)
-        operator = None
-        while src[:1] not in ('', ';', '{', '}', '[', ']', ')'):
-            for operator in self.expression_operators:
-                if src.startswith(operator):
-                    src = src[len(operator):]
-                    break
-            else:
-                operator = ' '
-            src, term2 = self._parse_expression_term(src.lstrip())
-            if term2 is NotImplemented:
-                break
-            else:
-                term = self.css_builder.combine_terms(term, operator, term2)
+        combine_terms = self.css_builder.combine_terms
+        term_function = self.css_builder.term_function
+        parse_term = self._parse_expression_term
+        skip_ws = self._skip_ws
+        operators = self.expression_operators
+        stops = self.expression_stops
+        end = len(src)
+
+        # The arguments of function terms are parsed by this loop too, the
+        # expressions they are part of wait on the stack for the ')'
+        stack = []
+        term = operator = None
+        first = True
+        while True:
+            pos, term2 = parse_term(src, pos)
+            if isinstance(term2, _FunctionStart):
+                stack.append((term2, term, operator, first, returnList))
+                term = operator = None
+                first = returnList = True
+                continue
 
-        if operator is None and returnList:
-            term = self.css_builder.combine_terms(term, None, None)
-            return src, term
-        else:
-            return src, term
+            while True:
+                if first:
+                    term, first = term2, False
+                    more = True
+                elif term2 is NotImplemented:
+                    more = False
+                else:
+                    term = combine_terms(term, operator, term2)
+                    more = True
+
+                if more and pos < end and src[pos] not in stops:
+                    ch = src[pos]
+                    if ch in operators:
+                        operator = ch
+                        pos += 1
+                    else:
+                        operator = ' '
+                    pos = skip_ws(src, pos)
+                    break
 
-    def _parse_expression_term(self, src):
+                if operator is None and returnList:
+                    term = combine_terms(term, None, None)
+                if not stack:
+                    return pos, term
+
+                # The expression was the arguments of a function term, which
+                # then continues the expression around it
+                function, outer_term, operator, first, returnList = stack.pop()
+                if src[pos] != ')':
+                    raise self.ParseError('Terminal function expression expected closing \')\'', src[pos:], src[function.ctxpos:])
+                term2 = term_function(function.name, term)
+                term = outer_term
+                pos = skip_ws(src, pos + 1)
+
+    def _parse_expression_term(self, src, pos):
         """term
         : unary_operator?
             [ NUMBER S* | PERCENTAGE S* | LENGTH S* | EMS S* | EXS S* | ANGLE S* |
             TIME S* | FREQ S* | function ]
         | STRING S* | IDENT S* | URI S* | RGB S* | UNICODERANGE S* | hexcolor
         ;
+
+        For a function only its name and '(' are read, the returned
+        _FunctionStart is completed by _parse_expression.
         """
-        ctxsrc = src
-
-        result, src = self._get_match_result(self.re_num, src)
-        if result is not None:
-            units, src = self._get_match_result(self.re_unit, src)
-            term = self.css_builder.term_number(result, units)
-            return src.lstrip(), term
-
-        result, src = self._get_string(src, self.re_uri)
-        if result is not None:
-            # XXX URL!!!!
-            term = self.css_builder.term_uri(result)
-            return src.lstrip(), term
-
-        result, src = self._get_string(src)
-        if result is not None:
-            term = self.css_builder.term_string(result)
-            return src.lstrip(), term
-
-        result, src = self._get_match_result(self.re_functionterm, src)
-        if result is not None:
-            src, params = self._parse_expression(src, True)
-            if src[0] != ')':
-                raise self.ParseError('Terminal function expression expected closing \')\'', src, ctxsrc)
-            src = src[1:].lstrip()
-            term = self.css_builder.term_function(result, params)
-            return src, term
-
-        result, src = self._get_match_result(self.re_rgbcolor, src)
-        if result is not None:
-            term = self.css_builder.term_rgb(result)
-            return src.lstrip(), term
-
-        result, src = self._get_match_result(self.re_unicoderange, src)
-        if result is not None:
-            term = self.css_builder.term_unicode_range(result)
-            return src.lstrip(), term
-
-        nsPrefix, src = self._get_match_result(self.re_namespace_selector, src)
-        result, src = self._get_ident(src)
-        if result is not None:
-            if nsPrefix is not None:
-                result = self.css_builder.resolve_namespace_prefix(nsPrefix, result)
-            term = self.css_builder.term_ident(result)
-            return src.lstrip(), term
-
-        result, src = self._get_match_result(self.re_unicodeid, src)
-        if result is not None:
-            term = self.css_builder.term_ident(result)
-            return src.lstrip(), term
-
-        return self.css_builder.term_unknown(src)
+        builder = self.css_builder
+        skip_ws = self._skip_ws
+
+        ctxpos = pos
+        # Most terms can only start with a few characters, looking at the
+        # first one saves trying the regexes that cannot match
+        ch = src[pos:pos + 1]
+
+        if ch in self.term_u_chars:
+            result, pos = self._get_string(src, pos, self.re_uri)
+            if result is not None:
+                # XXX URL!!!!
+                term = builder.term_uri(result)
+                return skip_ws(src, pos), term
+
+        if ch in self.term_string_chars:
+            result, pos = self._get_string(src, pos)
+            if result is not None:
+                term = builder.term_string(result)
+                return skip_ws(src, pos), term
+
+        match = self.re_term.match(src, pos)
+        if match is not None:
+            kind = match.lastgroup
+            pos = match.end()
+            if kind == 'number':
+                value, units = match.group('num', 'unit')
+                if units is not None:
+                    units = intern(units)
+                term = builder.term_number(value, units)
+            elif kind == 'function':
+                # _parse_expression goes on with the arguments
+                return pos, _FunctionStart(match.group(kind), ctxpos)
+            elif kind == 'ident':
+                nsPrefix, result = match.group('ns', 'name')
+                result = intern(result)
+                if nsPrefix is not None:
+                    result = builder.resolve_namespace_prefix(nsPrefix, result)
+                term = builder.term_ident(result)
+            elif kind == 'unicodeid':
+                term = builder.term_ident(match.group(kind))
+            elif kind == 'rgb':
+                term = builder.term_rgb(match.group(kind))
+            else:
+                term = builder.term_unicode_range(match.group(kind))
+            return skip_ws(src, pos), term
+
+        # Like at_ident the builder returns a tail of the source it got
+        rest, term = builder.term_unknown(src[pos:])
+        return len(src) - len(rest), term
 
     # ~ utility methods ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _get_ident(self, src, default=None):
-        return self._get_match_result(self.re_ident, src, default)
+    def _skip_ws(self, src, pos):
+        """Position of the first non whitespace character from pos on"""
+        return self.re_ws.match(src, pos).end()
+
+    def _get_at_keyword(self, src, pos):
+        """Lower cased name of the at-rule at pos and the position after it"""
+        if src.startswith('@', pos):
+            ident, end = self._get_ident(src, pos + 1)
+            if ident is not None:
+                return intern(ident.lower()), end
+        return None, pos
+
+    def _at_rule_end(self, src, pos, name):
+        """Position after the at-rule keyword name at pos and the whitespace
+        following it, None if there is no such at-rule at pos"""
+        keyword, end = self._get_at_keyword(src, pos)
+        if keyword == name:
+            return self._skip_ws(src, end)
+        return None
+
+    def _get_ident(self, src, pos, default=None):
+        # Identifiers repeat a lot and end up as keys of the builder's dicts
+        result = self.re_ident.match(src, pos)
+        if result:
+            return intern(result.group(1)), result.end()
+        else:
+            return default, pos
 
-    def _get_string(self, src, rexpression=None, default=None):
+    def _get_string(self, src, pos, rexpression=None, default=None):
         if rexpression is None:
             rexpression = self.re_string
-        result = rexpression.match(src)
+        result = rexpression.match(src, pos)
         if result:
-            strres = filter(None, result.groups())
-            if strres:
-                try:
-                    strres = strres[0]
-                except Exception:
-                    strres = result.groups()[0]
-            else:
-                strres = ''
-            return strres, src[result.end():]
+            # Each quoting style (and the bare url() form) has its own
+            # group and only the one of the matched alternative takes part
+            return result.group(result.lastindex), result.end()
         else:
-            return default, src
+            return default, pos
 
-    def _get_string_or_uri(self, src):
-        result, src = self._get_string(src, self.re_uri)
+    def _get_string_or_uri(self, src, pos):
+        result, pos = self._get_string(src, pos, self.re_uri)
         if result is None:
-            result, src = self._get_string(src)
-        return result, src
+            result, pos = self._get_string(src, pos)
+        return result, pos
 
-    def _get_match_result(self, rexpression, src, default=None, group=1):
-        result = rexpression.match(src)
+    def _get_match_result(self, rexpression, src, pos, default=None, group=1):
+        result = rexpression.match(src, pos)
         if result:
-            return result.group(group), src[result.end():]
+            return result.group(group), result.end()
         else:
-            return default, src
+            return default, pos
 